@@ -0,0 +1,250 @@
+# Packs masks of one clip into a chunked binary archive, read back through np.memmap
+# python archive.py --path_data '/Users/benjamin/Documents/data/basketball/2016_finals'
+
+import os
+import json
+import argparse
+import numpy as np
+
+import utils
+import CONFIG
+
+ARCHIVE_VERSION = 1
+
+# Record encodings
+ENCODING_EMPTY = 0  # no nonzero pixel, nothing stored
+ENCODING_BITS  = 1  # binary mask, bit-packed bounding box crop and single foreground value
+ENCODING_RAW   = 2  # non binary mask, raw uint8 bounding box crop
+
+class MaskArchiveWriter(object):
+    """
+    Writes masks into chunk files and keeps per-frame index of records.
+
+    Every mask is cropped to its bounding box. Binary masks (zero and one foreground value)
+    are bit-packed, other masks are stored as raw uint8 crop.
+
+    self.index : Dictionary with frame name as a key and dictionary of mask records
+                 {key: [chunk, offset, nbytes, encoding, y, x, h, w, value]} as a value.
+    """
+    def __init__(self, path_archive, frames_per_chunk=256):
+        super(MaskArchiveWriter, self).__init__()
+
+        self.path_archive       = path_archive
+        self.frames_per_chunk   = frames_per_chunk
+
+        self.shape  = None
+        self.chunks = []
+        self.index  = {}
+
+        self.file   = None
+
+        os.makedirs(self.path_archive, exist_ok=True)
+
+    def start_frame(self, frame):
+        '''
+        Starts new frame, opens new chunk file every frames_per_chunk frames.
+        '''
+
+        if len(self.index) % self.frames_per_chunk == 0:
+
+            if self.file is not None:
+                self.file.close()
+
+            self.chunks.append('chunk_{:05d}.bin'.format(len(self.chunks)))
+            self.file = open(os.path.join(self.path_archive, self.chunks[-1]), 'wb')
+
+        self.index[frame] = {}
+
+    def add_mask(self, frame, key, mask):
+        '''
+        Appends mask to the current chunk.
+        '''
+
+        if self.shape is None:
+            self.shape = mask.shape
+        elif self.shape != mask.shape:
+            raise ValueError('Mask {} of frame {} has shape {}, expected {}'.format(key, frame, mask.shape, self.shape))
+
+        ys, xs = np.nonzero(mask)
+
+        if len(ys) == 0:
+            self.index[frame][key] = [len(self.chunks) - 1, 0, 0, ENCODING_EMPTY, 0, 0, 0, 0, 0]
+            return
+
+        y, x = int(ys.min()), int(xs.min())
+        h, w = int(ys.max()) - y + 1, int(xs.max()) - x + 1
+        crop = mask[y:y+h, x:x+w]
+
+        values = np.unique(crop[crop > 0])
+
+        if len(values) == 1:
+            encoding, value = ENCODING_BITS, int(values[0])
+            data = np.packbits(crop > 0).tobytes()
+        else:
+            encoding, value = ENCODING_RAW, 0
+            data = np.ascontiguousarray(crop, dtype=np.uint8).tobytes()
+
+        offset = self.file.tell()
+        self.file.write(data)
+
+        self.index[frame][key] = [len(self.chunks) - 1, offset, len(data), encoding, y, x, h, w, value]
+
+    def close(self):
+        '''
+        Closes last chunk and writes index.
+        '''
+
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+        index = {
+            'version'   : ARCHIVE_VERSION,
+            'shape'     : list(self.shape) if self.shape is not None else None,
+            'chunks'    : self.chunks,
+            'frames'    : self.index
+        }
+
+        # Write index last and atomically, archive is valid only when index is there
+        path_index = os.path.join(self.path_archive, 'index.json')
+        with open(path_index + '.tmp', 'w') as file:
+            json.dump(index, file)
+        os.replace(path_index + '.tmp', path_index)
+
+class MaskArchive(object):
+    """
+    Reads masks from archive written by MaskArchiveWriter.
+
+    Chunk files are memory mapped, records are decoded directly from the mapped pages.
+    Lookup of a frame is a dictionary access.
+    """
+    def __init__(self, path_archive):
+        super(MaskArchive, self).__init__()
+
+        self.path_archive = path_archive
+
+        with open(os.path.join(self.path_archive, 'index.json')) as file:
+            index = json.load(file)
+
+        if index['version'] != ARCHIVE_VERSION:
+            raise ValueError('Unsupported mask archive version {}'.format(index['version']))
+
+        self.shape  = tuple(index['shape'])
+        self.chunks = index['chunks']
+        self.frames = index['frames']
+
+        self.memmaps = {}
+
+    def get_memmap(self, chunk):
+        '''
+        Returns (lazily opened) memory map of chunk file.
+        '''
+
+        if chunk not in self.memmaps:
+            path_chunk = os.path.join(self.path_archive, self.chunks[chunk])
+            # np.memmap can not map empty files
+            if os.path.getsize(path_chunk) == 0:
+                self.memmaps[chunk] = np.zeros(0, dtype=np.uint8)
+            else:
+                self.memmaps[chunk] = np.memmap(path_chunk, dtype=np.uint8, mode='r')
+
+        return self.memmaps[chunk]
+
+    def has_mask(self, frame, key):
+        return frame in self.frames and key in self.frames[frame]
+
+    def get_keys(self, frame):
+        '''
+        Returns keys of all masks stored for given frame.
+        '''
+        return list(self.frames.get(frame, {}).keys())
+
+    def get_mask(self, frame, key):
+        '''
+        Returns full frame uint8 mask.
+        '''
+
+        chunk, offset, nbytes, encoding, y, x, h, w, value = self.frames[frame][key]
+
+        mask = np.zeros(self.shape, dtype=np.uint8)
+
+        if encoding == ENCODING_EMPTY:
+            return mask
+
+        # View into mapped chunk, no read copy
+        data = self.get_memmap(chunk)[offset:offset+nbytes]
+
+        if encoding == ENCODING_BITS:
+            crop = np.unpackbits(data, count=h*w).reshape(h, w)
+            mask[y:y+h, x:x+w] = crop * np.uint8(value)
+        else:
+            mask[y:y+h, x:x+w] = data.reshape(h, w)
+
+        return mask
+
+    def get_sparse_mask(self, frame, key):
+        '''
+        Returns utils.SparseMask of stored bounding box crop, full frame mask is not allocated.
+        '''
+
+        chunk, offset, nbytes, encoding, y, x, h, w, value = self.frames[frame][key]
+
+        if encoding == ENCODING_EMPTY:
+            return utils.SparseMask(self.shape, 0, 0, np.zeros((0, 0), dtype=np.uint8))
+
+        data = self.get_memmap(chunk)[offset:offset+nbytes]
+
+        if encoding == ENCODING_BITS:
+            crop = np.unpackbits(data, count=h*w).reshape(h, w) * np.uint8(value)
+        else:
+            crop = np.array(data).reshape(h, w)
+
+        return utils.SparseMask(self.shape, y, x, crop)
+
+def get_court_key(feature):
+    return '/'.join(['court', feature])
+
+def get_person_key(person, part):
+    return '/'.join(['person', person, part])
+
+def pack_masks(data_loader, path_archive, frames_per_chunk=256):
+    '''
+    Converts masks tree of a clip into archive. Masks are read with given DataLoader.
+    '''
+
+    path_person = os.path.join(data_loader.path_masks, 'person')
+
+    writer = MaskArchiveWriter(path_archive, frames_per_chunk)
+
+    for f in data_loader.frames:
+
+        print('Packing frame {}'.format(f))
+
+        writer.start_frame(f)
+
+        for c in CONFIG.COURT_FEATURES:
+
+            path = os.path.join(data_loader.path_masks, 'court', c, 'mask', f + '.png')
+
+            if os.path.exists(path):
+                writer.add_mask(f, get_court_key(c), data_loader.read_mask(path))
+
+        for p in data_loader.frames_person_on_court[f]:
+            for m in data_loader.frames_person_masks[f].get(p, []):
+                writer.add_mask(f, get_person_key(p, m), data_loader.read_mask(os.path.join(path_person, p, m, f + '.png')))
+
+    writer.close()
+
+if __name__ == '__main__':
+
+    import game
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--path_data", type=str, help="Path to images, masks, list of frames.", required=True)
+    parser.add_argument("--path_archive", type=str, default=None, help="Output path, default is masks/archive in path_data.", required=False)
+    parser.add_argument("--frames_per_chunk", type=int, default=256, help="Number of frames stored in one chunk file.", required=False)
+    args = parser.parse_args()
+
+    data_loader = game.DataLoader(args.path_data)
+
+    pack_masks(data_loader, args.path_archive or data_loader.path_archive, args.frames_per_chunk)
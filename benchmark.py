@@ -0,0 +1,229 @@
+# Times pipeline stages on synthetic clips (synthetic.py) and checks homography against ground truth
+# python benchmark.py --resolutions 640x360 1280x720 1920x1080 --frames 10 50
+# python benchmark.py --resolutions 3840x2160 --frames 10 --fit_pyramid_levels 0 1 2 3
+
+import os
+import cv2
+import json
+import time
+import argparse
+import tempfile
+import collections
+import numpy as np
+
+import game
+import archive
+import utils
+import visual
+import profiling
+import synthetic
+
+import CONFIG
+
+STAGES = ['load', 'keypoints', 'homography', 'positions', 'render', 'write']
+
+def get_homography_error(homography, homography_true):
+    '''
+    Returns mean and max distance in image pixels between all court keypoints projected with estimated
+    and ground truth homography. Inf if homography was not found.
+    '''
+
+    if homography is None:
+        return np.inf, np.inf
+
+    map_keypoints = np.array([list(CONFIG.COURT_KEYPOINTS['values'].values())], dtype=np.float64)
+
+    distance = np.linalg.norm(cv2.perspectiveTransform(map_keypoints, homography) - cv2.perspectiveTransform(map_keypoints, homography_true), axis=2)
+
+    return float(np.mean(distance)), float(np.max(distance))
+
+def get_keypoint_deviations(image_keypoints, image_keypoints_reference):
+    '''
+    Returns list of distances in image pixels between keypoints and reference keypoints. Inf for keypoint
+    found only in one of them.
+    '''
+
+    deviations = []
+
+    for k, v in image_keypoints_reference.items():
+
+        if v is None and image_keypoints[k] is None:
+            continue
+
+        if v is None or image_keypoints[k] is None:
+            deviations.append(np.inf)
+        else:
+            deviations.append(float(np.hypot(image_keypoints[k][0] - v[0], image_keypoints[k][1] - v[1])))
+
+    return deviations
+
+def run_benchmark(path_data, path_output, backend='png', mask_downsample=1, fit_pyramid_levels=0):
+    '''
+    Runs all stages of main.py frame loop on a clip, one after another. Returns dictionary with
+    per-stage times in seconds of every frame and homography errors of every frame.
+
+    Homography is computed with GameHandler.compute_homography, keypoints and homography are wall times of its
+    profiler stages (0 if the stage did not run, e.g. homography with less than 4 keypoints).
+
+    With fit_pyramid_levels > 0 keypoints are also extracted with full resolution fit (not timed), distances
+    between keypoints of both fits are returned as deviations.
+    '''
+
+    data_loader = game.DataLoader(path_data, backend, mask_downsample)
+
+    game_handler = game.GameHandler(mask_downsample, fit_pyramid_levels=fit_pyramid_levels)
+
+    visual_handler = visual.VisualizationHandler(visual.PngSequenceSink(path_output))
+    visual_handler.set_map_court(data_loader.get_map_court())
+
+    homographies_true = np.load(os.path.join(path_data, 'homography.npy'))
+
+    times = collections.defaultdict(list)
+    errors = []
+    deviations = []
+
+    enabled = profiling.profiler.enabled
+    profiling.profiler.enabled = True
+
+    for f in data_loader.get_frames():
+
+        t = time.perf_counter()
+
+        masks_court, masks_person, image = data_loader.get_frame_data(f)
+
+        times['load'].append(time.perf_counter() - t)
+
+        profiling.profiler.reset()
+
+        game_handler.masks['court'] = masks_court
+        game_handler.compute_homography()
+
+        for stage in ['keypoints', 'homography']:
+            times[stage].append(sum(wall for wall, cpu in profiling.profiler.times.get(stage, [])))
+
+        t = time.perf_counter()
+
+        game_handler.masks['person'] = masks_person
+        game_handler.compute_person_position_on_image(data_loader.frames_person_on_court[f])
+        game_handler.compute_person_position_on_court()
+        game_handler.compute_ball_possesion(data_loader.frames_ball_posession[f])
+
+        times['positions'].append(time.perf_counter() - t)
+        t = time.perf_counter()
+
+        visual_handler.set_image(image)
+        out_image = visual_handler.draw(game_handler.person, game_handler.masks['court'], game_handler.ball_possesion, game_handler.image_keypoints_ordered)
+
+        times['render'].append(time.perf_counter() - t)
+        t = time.perf_counter()
+
+        visual_handler.sink.write(f, out_image)
+
+        times['write'].append(time.perf_counter() - t)
+
+        errors.append(get_homography_error(game_handler.homography, homographies_true[int(f)]))
+
+        if fit_pyramid_levels > 0:
+            deviations.extend(get_keypoint_deviations(game_handler.image_keypoints,
+                utils.get_image_mask_keypoints(masks_court, CONFIG.COURT_KEYPOINTS, game_handler.mask_scale)))
+
+        game_handler.reset()
+
+    profiling.profiler.enabled = enabled
+    profiling.profiler.reset()
+
+    visual_handler.sink.close()
+
+    return {'times': times, 'errors': errors, 'deviations': deviations}
+
+def get_summary(result):
+    '''
+    Returns mean time of each stage in milliseconds, frames per second, homography errors and keypoint
+    deviations from full resolution fit (None if it was not compared).
+    '''
+
+    times = result['times']
+    errors = np.array(result['errors'])
+    deviations = np.array(result['deviations'])
+
+    frames = len(errors)
+    total = sum(np.sum(times[s]) for s in STAGES)
+
+    finite = deviations[np.isfinite(deviations)]
+
+    return {
+        'frames'                        : frames,
+        'ms'                            : {s: 1000 * float(np.mean(times[s])) for s in STAGES},
+        'fps'                           : frames / total if total > 0 else 0.,
+        'homography_error_mean'         : float(np.mean(errors[:, 0])),
+        'homography_error_max'          : float(np.max(errors[:, 1])),
+        'homography_missing'            : int(np.sum(~np.isfinite(errors[:, 0]))),
+        'keypoint_deviation_mean'       : float(np.mean(finite)) if len(finite) else None,
+        'keypoint_deviation_max'        : float(np.max(finite)) if len(finite) else None,
+        'keypoint_deviation_missing'    : int(np.sum(~np.isfinite(deviations)))
+    }
+
+def get_report(resolution, summary):
+    '''
+    Returns one line report of a benchmark run.
+    '''
+
+    stages = ' '.join('{} {:.1f}'.format(s, summary['ms'][s]) for s in STAGES)
+
+    report = '{:>12} {:>4} frames | ms/frame {} | {:.1f} fps | homography error {:.3f} px (max {:.3f}, missing {})'.format(
+        resolution, summary['frames'], stages, summary['fps'],
+        summary['homography_error_mean'], summary['homography_error_max'], summary['homography_missing'])
+
+    if summary['keypoint_deviation_mean'] is not None:
+        report += ' | keypoints vs full fit {:.3f} px (max {:.3f}, missing {})'.format(
+            summary['keypoint_deviation_mean'], summary['keypoint_deviation_max'], summary['keypoint_deviation_missing'])
+
+    return report
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--resolutions", type=str, nargs='+', default=['640x360', '1280x720', '1920x1080'], help="Image sizes as <width>x<height>.", required=False)
+    parser.add_argument("--frames", type=int, nargs='+', default=[10, 50], help="Numbers of frames of benchmarked clips.", required=False)
+    parser.add_argument("--pan", type=float, default=2., help="Camera pan in pixels per frame, 0 for static camera.", required=False)
+    parser.add_argument("--backend", type=str, default='png', choices=['png', 'archive'], help="Read masks from png tree or from archive, packed on first use.", required=False)
+    parser.add_argument("--mask_downsample", type=int, default=1, help="Downsample masks by this factor at load time.", required=False)
+    parser.add_argument("--fit_pyramid_levels", type=int, nargs='+', default=[0], help="Pyramid levels of court feature fit, 0 fits full masks. Pyramid fits are compared with full fit.", required=False)
+    parser.add_argument("--path_tmp", type=str, default=None, help="Directory for generated clips and output, kept for next runs (default temporary directory).", required=False)
+    parser.add_argument("--output_json", type=str, default=None, help="Write summaries of all runs to this file.", required=False)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as path_tmp:
+
+        path_tmp = args.path_tmp or path_tmp
+
+        summaries = {}
+
+        for resolution in args.resolutions:
+
+            width, height = [int(v) for v in resolution.split('x')]
+
+            for frames in args.frames:
+
+                name = '{}_{}_{}'.format(resolution, frames, args.pan)
+                path_data = os.path.join(path_tmp, name)
+
+                # Clips are generated once and reused
+                if not os.path.exists(os.path.join(path_data, 'homography.npy')):
+                    synthetic.generate_clip(path_data, frames, width, height, args.pan)
+
+                if args.backend == 'archive' and not os.path.exists(os.path.join(path_data, 'masks', 'archive', 'index.json')):
+                    data_loader = game.DataLoader(path_data)
+                    archive.pack_masks(data_loader, data_loader.path_archive)
+
+                for levels in args.fit_pyramid_levels:
+
+                    name_run = name if levels == 0 else '{}_pyramid{}'.format(name, levels)
+
+                    summaries[name_run] = get_summary(run_benchmark(path_data, os.path.join(path_tmp, 'output', name), args.backend, args.mask_downsample, levels))
+
+                    print(get_report(resolution if levels == 0 else '{} L{}'.format(resolution, levels), summaries[name_run]))
+
+        if args.output_json:
+            with open(args.output_json, 'w') as file:
+                json.dump(summaries, file, indent=4)
@@ -0,0 +1,307 @@
+# Decodes frames in a dedicated loader process into a ring of shared memory slots, consumers (worker processes
+# or the main process) read images and court masks as numpy views without copying or pickling pixel data
+# python main.py --path_data '/Users/benjamin/Documents/data/basketball/2016_finals' --workers 4 --decode_slots 8
+
+import queue
+import multiprocessing
+import multiprocessing.shared_memory
+import numpy as np
+
+import game
+import utils
+import profiling
+
+import CONFIG
+
+class FrameDescriptor(object):
+    """
+    Small description of frame decoded into a slot of SharedFrameRing, sent between processes instead of arrays.
+
+    self.frame          : str, frame name
+    self.slot           : int, index of slot with image and court masks
+    self.features       : list of court features available for this frame (game.CourtMasks)
+    self.decoded        : list of court features stored in the slot, others are decoded by consumer on access
+    self.image          : bool, image is stored in the slot
+    self.masks_person   : Dictionary with person masks, sent with descriptor (utils.SparseMask crops are small)
+    self.records        : profiler records of decoding this frame in the loader process
+    self.court_mask_stats : court mask statistics of decoding this frame in the loader process (DataLoader.court_mask_stats)
+    """
+    def __init__(self, frame, slot, features, decoded, image, masks_person, records, court_mask_stats):
+        super(FrameDescriptor, self).__init__()
+
+        self.frame          = frame
+        self.slot           = slot
+        self.features       = features
+        self.decoded        = decoded
+        self.image          = image
+        self.masks_person   = masks_person
+        self.records        = records
+        self.court_mask_stats = court_mask_stats
+
+class SharedFrameRing(object):
+    """
+    Fixed number of shared memory slots. Every slot holds image and court masks of one frame at fixed offsets.
+
+    Ring is created by the main process, pickled copies attach to the same memory by name.
+    Only the creating process unlinks the memory.
+
+    image_shape : tuple, shape of BGR image, None if images are not stored
+    mask_shape  : tuple, shape of court mask
+    features    : list of court features stored in slot, in slot order
+    slots       : int, number of slots
+    """
+    def __init__(self, image_shape, mask_shape, features, slots, names=None):
+        super(SharedFrameRing, self).__init__()
+
+        self.image_shape    = image_shape
+        self.mask_shape     = mask_shape
+        self.features       = list(features)
+        self.slots          = slots
+
+        # Byte offset of image and of each court feature mask inside a slot
+        self.offsets    = {}
+        offset          = 0
+
+        if image_shape is not None:
+            self.offsets['image'] = offset
+            offset += int(np.prod(image_shape))
+
+        for f in self.features:
+            self.offsets[f] = offset
+            offset += int(np.prod(mask_shape))
+
+        self.slot_size = max(1, offset)
+
+        self.owner = names is None
+
+        if self.owner:
+            self.memory = [multiprocessing.shared_memory.SharedMemory(create=True, size=self.slot_size) for _ in range(slots)]
+        else:
+            self.memory = [multiprocessing.shared_memory.SharedMemory(name) for name in names]
+
+    def __getstate__(self):
+        return {'image_shape': self.image_shape, 'mask_shape': self.mask_shape, 'features': self.features,
+            'slots': self.slots, 'names': [m.name for m in self.memory]}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def get_view(self, slot, name):
+        '''
+        Returns numpy array viewing image or court mask stored in slot.
+        '''
+
+        shape = self.image_shape if name == 'image' else self.mask_shape
+
+        return np.ndarray(shape, dtype=np.uint8, buffer=self.memory[slot].buf, offset=self.offsets[name])
+
+    def write(self, slot, image, masks_court):
+        '''
+        Copies decoded image and court masks into slot. Returns list of stored court features.
+        '''
+
+        if self.image_shape is not None and image is not None:
+
+            if image.shape != self.image_shape:
+                raise ValueError('Image shape {} does not match shared memory slot {}'.format(image.shape, self.image_shape))
+
+            self.get_view(slot, 'image')[:] = image
+
+        decoded = []
+
+        for f, mask in masks_court.items():
+
+            if f not in self.offsets:
+                continue
+
+            if mask.shape != self.mask_shape:
+                raise ValueError('Court mask {} shape {} does not match shared memory slot {}'.format(f, mask.shape, self.mask_shape))
+
+            self.get_view(slot, f)[:] = mask
+            decoded.append(f)
+
+        return decoded
+
+    def close(self):
+
+        for m in self.memory:
+            m.close()
+
+            if self.owner:
+                m.unlink()
+
+def get_slot_features(image=True):
+    '''
+    Returns court features decoded into slots, the same as DataLoader.get_frame_data decodes in advance.
+    '''
+
+    return utils.get_keypoint_features(CONFIG.COURT_KEYPOINTS) + (['basket_ball'] if image else [])
+
+def run_loader(data_loader, frames, ring, free, ready, image=True, threads=2, profile=False):
+    '''
+    Loader process. Decodes frames in order with DataLoader.iterate_frames, waits for a free slot,
+    copies image and court masks into it and sends FrameDescriptor to ready queue. None marks the end,
+    an exception is sent instead if decoding failed.
+
+    Ring is not closed here, with fork start method it is the main process copy which owns the memory.
+    '''
+
+    profiling.profiler.enabled = profile
+    profiling.profiler.reset()
+
+    try:
+        for f, masks_court, masks_person, frame_image in data_loader.iterate_frames(frames=frames, prefetch=threads, threads=threads, image=image):
+
+            slot = free.get()
+
+            decoded = ring.write(slot, frame_image, masks_court.masks)
+
+            ready.put(FrameDescriptor(f, slot, masks_court.features, decoded, frame_image is not None, masks_person,
+                profiling.profiler.pop_records(), data_loader.pop_court_mask_stats()))
+
+        ready.put(None)
+
+    except Exception as e:
+        ready.put(e)
+
+class DecodeService(object):
+    """
+    Dedicated loader process decoding frames with DataLoader into SharedFrameRing.
+
+    Loader takes a free slot for every frame, consumer gets FrameDescriptor (get), reads arrays from the slot
+    (get_frame_data) and gives the slot back (release) when it does not use them anymore. At most slots frames
+    are decoded ahead of consumers. Descriptors are pickled to worker processes, arrays are not.
+
+    Service is pickled to worker processes without the loader process, workers can only read and release slots.
+
+    frames      : list of frame names, decoded in this order, for empty list no memory or process is created
+    slots       : int, number of shared memory slots
+    image       : bool, if False images are not decoded
+    threads     : int, number of decoding threads in the loader process
+    """
+    def __init__(self, data_loader, frames, slots=8, image=True, threads=2):
+        super(DecodeService, self).__init__()
+
+        self.frames = frames
+
+        # Nothing to decode, consumers get no frames
+        if not frames:
+            self.ring, self.free, self.ready, self.process = None, None, None, None
+            return
+
+        # Layout of slots is taken from the first frame, all frames and masks have the size of the image
+        image_shape = data_loader.get_frame_image(frames[0]).shape
+        mask_shape  = tuple(-(-n // data_loader.mask_downsample) for n in image_shape[:2])
+
+        self.ring = SharedFrameRing(image_shape if image else None, mask_shape, get_slot_features(image), max(1, slots))
+
+        self.free   = multiprocessing.Queue()
+        self.ready  = multiprocessing.Queue()
+
+        for slot in range(self.ring.slots):
+            self.free.put(slot)
+
+        self.process = multiprocessing.Process(target=run_loader, args=(data_loader, frames, self.ring, self.free, self.ready,
+            image, threads, profiling.profiler.enabled), daemon=True)
+        self.process.start()
+
+    def __getstate__(self):
+        return {'frames': self.frames, 'ring': self.ring, 'free': self.free, 'ready': self.ready, 'process': None}
+
+    def get(self):
+        '''
+        Returns FrameDescriptor of the next decoded frame, None after the last frame.
+        '''
+
+        if self.ring is None:
+            return None
+
+        while True:
+            try:
+                item = self.ready.get(timeout=1)
+                break
+            except queue.Empty:
+                # Everything sent by finished loader is already in the queue
+                if self.process is not None and not self.process.is_alive():
+                    try:
+                        item = self.ready.get(timeout=1)
+                        break
+                    except queue.Empty:
+                        raise RuntimeError('Decode process exited with code {}'.format(self.process.exitcode))
+
+        if isinstance(item, Exception):
+            raise item
+
+        return item
+
+    def get_frame_data(self, descriptor, data_loader):
+        '''
+        Returns court masks, person masks and image (None if not decoded) of described frame, as DataLoader.get_frame_data.
+        Image and court masks are views of the slot, valid until the slot is released. Court masks which are not
+        in the slot are decoded with data_loader on access. Loader profiler records and court mask statistics
+        are added to this process.
+        '''
+
+        profiling.profiler.add_records(descriptor.records)
+        data_loader.add_court_mask_stats(descriptor.court_mask_stats)
+
+        masks_court = game.CourtMasks(data_loader, descriptor.frame, descriptor.features)
+        masks_court.masks.update({f: self.ring.get_view(descriptor.slot, f) for f in descriptor.decoded})
+
+        image = self.ring.get_view(descriptor.slot, 'image') if descriptor.image else None
+
+        return masks_court, descriptor.masks_person, image
+
+    def release(self, descriptor):
+        '''
+        Gives slot of described frame back to the loader.
+        '''
+
+        self.free.put(descriptor.slot)
+
+    def iterate_frames(self, data_loader):
+        '''
+        Yields (frame, masks_court, masks_person, image) for every frame, as DataLoader.iterate_frames.
+        Slot of a frame is released when the next frame is requested.
+        '''
+
+        while True:
+
+            descriptor = self.get()
+
+            if descriptor is None:
+                return
+
+            try:
+                yield (descriptor.frame,) + self.get_frame_data(descriptor, data_loader)
+            finally:
+                self.release(descriptor)
+
+    def iterate_descriptors(self):
+        '''
+        Yields FrameDescriptor of every frame, consumer releases slots.
+        '''
+
+        while True:
+
+            descriptor = self.get()
+
+            if descriptor is None:
+                return
+
+            yield descriptor
+
+    def close(self):
+        '''
+        Stops the loader process (if consumers did not read all frames) and frees shared memory.
+        '''
+
+        if self.process is not None:
+
+            if self.process.is_alive():
+                self.process.terminate()
+
+            self.process.join()
+
+        if self.ring is not None:
+            self.ring.close()
@@ -1,10 +1,16 @@
 import os
 import cv2
+import copy
+import json
 import random
+import collections
+import collections.abc
+import concurrent.futures
 import numpy as np
-import scipy.ndimage as ndi
 
 import utils
+import archive
+import profiling
 
 import CONFIG
 
@@ -15,14 +21,32 @@ class DataLoader(object):
     self.frames                 : List of all frame names
     self.frames_person_on_court : Dictionary with frame image name as a key and list of person on the court at this frame.
     self.frames_ball_posession  : Dictionary with frame image name as a key and player name who is in a ball possesion.
+    self.frames_person_masks    : Dictionary with frame image name as a key and dictionary {person: [available body part masks]}.
+                                  Built once from masks/person tree and persisted in masks/person_index.json.
+
+    backend                     : str, ['png', 'archive'], read masks from png tree or from archive packed with archive.py
+    mask_downsample             : int, masks are downsampled by this factor at load time (every n-th row and column,
+                                  court masks are max pooled)
+    sparse_person_masks         : bool, person masks are loaded as utils.SparseMask (bounding box and crop), memory and
+                                  work on them scale with the size of the body part and not with the size of the frame
 
     """
-    def __init__(self, path_data):
+    def __init__(self, path_data, backend='png', mask_downsample=1, sparse_person_masks=True):
         super(DataLoader, self).__init__()
 
         self.path_masks     = os.path.join(path_data, 'masks')
         self.path_images    = os.path.join(path_data, 'images')
         self.path_map_court = os.path.join(path_data, 'map_court.png')
+        self.path_archive   = os.path.join(self.path_masks, 'archive')
+        self.path_person_index = os.path.join(self.path_masks, 'person_index.json')
+
+        self.archive = archive.MaskArchive(self.path_archive) if backend == 'archive' else None
+
+        self.mask_downsample = mask_downsample
+        self.sparse_person_masks = sparse_person_masks
+
+        # Number of frames and number of decodes of each court feature
+        self.court_mask_stats = collections.Counter()
 
         # Load the frames and the list of all players, ball possesions, etc
         with open(os.path.join(self.path_masks, 'frames.txt')) as file:
@@ -33,11 +57,77 @@ class DataLoader(object):
             self.frames_person_on_court = {f.split(', ')[0]: f.split(', ')[2:] for f in data}
             self.frames_ball_posession  = {f.split(', ')[0]: f.split(', ')[1] for f in data}
 
+        # Available person masks, archive has its own index
+        if self.archive is None:
+            self.build_person_index()
+
+    def build_person_index(self, rescan=False):
+        '''
+        Builds index of available (person, body part, frame) masks.
+
+        Index is loaded from masks/person_index.json. Person directories are rescanned only if
+        modification time of any body part directory changed, i.e. when masks were added or removed.
+        Updated index is saved back, if masks directory is read only the index is used only in memory.
+
+        rescan : bool, if True ignore saved index and rescan whole tree
+        '''
+
+        path_person = os.path.join(self.path_masks, 'person')
+
+        index = {}
+        if os.path.exists(self.path_person_index) and not rescan:
+            with open(self.path_person_index) as file:
+                index = json.load(file)
+
+        changed = False
+        index_new = {}
+
+        for p in sorted(os.listdir(path_person)):
+
+            if 'DS' in p or not os.path.isdir(os.path.join(path_person, p)):
+                continue
+
+            parts = sorted(m for m in os.listdir(os.path.join(path_person, p)) if 'DS' not in m)
+            mtimes = {m: os.path.getmtime(os.path.join(path_person, p, m)) for m in parts}
+
+            # Reuse saved listing if nothing changed for this person
+            if p in index and index[p]['mtimes'] == mtimes:
+                index_new[p] = index[p]
+                continue
+
+            changed = True
+            index_new[p] = {
+                'mtimes' : mtimes,
+                'frames' : {m: sorted(f[:-len('.png')] for f in os.listdir(os.path.join(path_person, p, m)) if f.endswith('.png'))
+                    for m in parts}
+            }
+
+        if changed or set(index_new) != set(index):
+            try:
+                with open(self.path_person_index + '.tmp', 'w') as file:
+                    json.dump(index_new, file)
+                os.replace(self.path_person_index + '.tmp', self.path_person_index)
+            except OSError as e:
+                print('Person index not saved ({}), using it in memory'.format(e))
+
+        self.frames_person_masks = {f: {} for f in self.frames}
+
+        for p, p_value in index_new.items():
+            for m, frames in p_value['frames'].items():
+                for f in frames:
+                    if f in self.frames_person_masks:
+                        self.frames_person_masks[f].setdefault(p, []).append(m)
+
     def get_frame_image(self, frame):
         '''
         Returns image for given frame.
         '''
-        return cv2.imread(os.path.join(self.path_images, frame + '.jpg'))
+
+        path = os.path.join(self.path_images, frame + '.jpg')
+
+        profiling.profiler.count_file(path)
+
+        return cv2.imread(path)
 
     def get_map_court(self):
         '''
@@ -45,27 +135,136 @@ class DataLoader(object):
         '''
         return cv2.imread(self.path_map_court)
 
-    def get_masks_court(self, frame):
+    def read_mask(self, path, sparse=False, downsample=True):
+        '''
+        Returns single channel uint8 mask stored as png. Masks are grayscale, decoding to one channel
+        gives the same values as taking first channel of BGR image.
 
+        sparse      : bool, return utils.SparseMask, full size array is dropped right after decoding
+        downsample  : bool, if False mask is returned in full resolution, otherwise it is max pooled (downsample_mask)
         '''
-        Returns dictionary with court feature masks for given frame.
+
+        profiling.profiler.count_file(path)
+
+        mask = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+
+        if downsample:
+            mask = self.downsample_mask(mask, max_pool=True)
+
+        return utils.get_sparse_mask(mask) if sparse else mask
+
+    def get_archive_mask(self, frame, key, sparse=False, downsample=True):
+        '''
+        Returns single channel uint8 mask stored in archive.
+
+        sparse      : bool, return utils.SparseMask decoded from the stored crop, without full size array
+        downsample  : bool, if False mask is returned in full resolution, otherwise it is max pooled (downsample_mask)
         '''
 
-        masks_court = {f: cv2.imread(os.path.join(self.path_masks, 'court', f, 'mask', frame + '.png'))[:,:,0]
-            for f in CONFIG.COURT_FEATURES if 'DS' not in f}
+        # Stored record size
+        profiling.profiler.count('bytes_read', self.archive.frames[frame][key][2])
+
+        mask = self.archive.get_sparse_mask(frame, key) if sparse else self.archive.get_mask(frame, key)
+
+        return self.downsample_mask(mask, max_pool=True) if downsample else mask
+
+    def downsample_mask(self, mask, max_pool=False):
+        '''
+        Returns mask downsampled by self.mask_downsample. Sample (i, j) is pixel (i*n, j*n) of original mask,
+        image coordinates are recovered by multiplying with n. Mask is full size array or utils.SparseMask.
+
+        max_pool : bool, sample is maximum of n x n neighbourhood centered on pixel (i*n, j*n) instead of the pixel,
+                   lines thinner than n pixels stay connected and small body parts do not vanish
+        '''
+
+        if self.mask_downsample == 1:
+            return mask
+
+        if isinstance(mask, utils.SparseMask):
+            return utils.downsample_sparse_mask(mask, self.mask_downsample, max_pool)
+
+        if max_pool:
+            # Odd kernel, so it is centered on the sampled pixel
+            size = self.mask_downsample + 1 - self.mask_downsample % 2
+            mask = cv2.dilate(mask, np.ones((size, size), dtype=np.uint8))
+
+        return np.ascontiguousarray(mask[::self.mask_downsample, ::self.mask_downsample])
+
+    def get_masks_court(self, frame, features=None):
+
+        '''
+        Returns CourtMasks, mapping with court feature masks for given frame. Masks are decoded on first access.
+
+        features : list of court features available in the mapping, all by default
+        '''
+
+        features = CONFIG.COURT_FEATURES if features is None else features
+
+        if self.archive is not None:
+            features = [f for f in features if self.archive.has_mask(frame, archive.get_court_key(f))]
+        else:
+            features = [f for f in features if 'DS' not in f]
+
+        self.court_mask_stats['frames'] += 1
+        profiling.profiler.count('court_masks_available', len(features))
+
+        return CourtMasks(self, frame, features)
+
+    def read_mask_court(self, frame, feature):
+
+        '''
+        Returns decoded court feature mask for given frame.
+        '''
+
+        self.court_mask_stats[feature] += 1
+        profiling.profiler.count('court_masks_decoded')
+
+        # Masks are downsampled after the hack, which counts objects in full resolution mask
+        if self.archive is not None:
+            mask = self.get_archive_mask(frame, archive.get_court_key(feature), downsample=False)
+        else:
+            mask = self.read_mask(os.path.join(self.path_masks, 'court', feature, 'mask', frame + '.png'), downsample=False)
 
         # DIRTY Hack
-        if 'line_court_center' in masks_court:
+        if feature == 'line_court_center':
 
-            _,thresh = cv2.threshold(masks_court['line_court_center'], 0.5, 255, cv2.THRESH_BINARY)
+            _,thresh = cv2.threshold(mask, 0.5, 255, cv2.THRESH_BINARY)
             contours, hierarchy = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
             number_of_objects_in_image= len(contours)
             
             if number_of_objects_in_image == 1:
                 # print ("The number of objects in this image: ", str(number_of_objects_in_image))
-                masks_court['line_court_center'] = np.zeros(masks_court['line_court_center'].shape)
+                mask = np.zeros_like(mask)
+
+        # Thin court lines must not break into pieces
+        return self.downsample_mask(mask, max_pool=True)
+
+    def get_untouched_court_features(self):
+        '''
+        Returns dictionary with court feature as a key and number of frames in which it was never decoded as a value.
+        '''
+
+        frames = self.court_mask_stats['frames']
+
+        return {f: frames - self.court_mask_stats[f] for f in CONFIG.COURT_FEATURES if self.court_mask_stats[f] < frames}
 
-        return masks_court
+    def pop_court_mask_stats(self):
+        '''
+        Returns court mask statistics counted since the last call and starts counting again.
+        Used by worker and loader processes, which send them to the main process.
+        '''
+
+        stats = self.court_mask_stats
+        self.court_mask_stats = collections.Counter()
+
+        return stats
+
+    def add_court_mask_stats(self, stats):
+        '''
+        Adds court mask statistics counted in another process.
+        '''
+
+        self.court_mask_stats.update(stats)
 
     def get_masks_person(self, frame):
 
@@ -76,28 +275,207 @@ class DataLoader(object):
         person = self.frames_person_on_court[frame]
 
         masks_person = {}
-        
-        for p in person:
 
-            masks = [f for f in os.listdir(os.path.join(self.path_masks, 'person', p)) if 'DS' not in f]
+        if self.archive is not None:
 
-            for m in masks:
+            for k in self.archive.get_keys(frame):
 
-                if not os.path.exists(os.path.join(self.path_masks, 'person', p, m, frame + '.png')):
+                if not k.startswith('person/'):
                     continue
 
-                masks_person['_'.join([p,m])] = cv2.imread(os.path.join(self.path_masks, 'person', p, m, frame + '.png'))[:,:,0]
+                _, p, m = k.split('/')
+
+                if p in person:
+                    masks_person['_'.join([p,m])] = self.get_archive_mask(frame, k, self.sparse_person_masks)
+
+            return masks_person
+
+        # Availability is answered from index, no listdir or exists calls per frame
+        frame_masks = self.frames_person_masks.get(frame, {})
+
+        for p in person:
+
+            for m in frame_masks.get(p, []):
+
+                masks_person['_'.join([p,m])] = self.read_mask(os.path.join(self.path_masks, 'person', p, m, frame + '.png'), self.sparse_person_masks)
 
         return masks_person
 
+    def get_persons(self):
+        '''
+        Returns sorted list of all person on the court in any frame.
+        '''
+        return sorted(set(p for f in self.frames for p in self.frames_person_on_court[f]))
+
+    def get_frames(self, every_nth_frame=1):
+        '''
+        Returns list of frame names which should be analyzed.
+        '''
+        return [f for f in self.frames if int(f) % every_nth_frame == 0]
+
+    def get_frame_data(self, frame, image=True):
+        '''
+        Returns court masks, person masks and image (None if image is False) for given frame.
+        '''
+
+        with profiling.profiler.stage('load_masks_court'):
+            masks_court = self.get_masks_court(frame)
+            # Keypoint features are used by every homography path, basket ball by drawing
+            masks_court.load(utils.get_keypoint_features(CONFIG.COURT_KEYPOINTS) + (['basket_ball'] if image else []))
+
+        with profiling.profiler.stage('load_masks_person'):
+            masks_person = self.get_masks_person(frame)
+
+        if image:
+            with profiling.profiler.stage('load_image'):
+                image = self.get_frame_image(frame)
+        else:
+            image = None
+
+        return masks_court, masks_person, image
+
+    def iterate_frames(self, every_nth_frame=1, prefetch=4, threads=2, image=True, frames=None):
+        '''
+        Yields (frame, masks_court, masks_person, image) for every n-th frame, in frame order.
+
+        Next frames are decoded in a thread pool while the current one is processed
+        (cv2.imread releases the GIL, so disk reads and decoding overlap with computation).
+
+        every_nth_frame : int, analyze every n-th frame
+        prefetch        : int, maximum number of frames decoded ahead, 0 disables prefetching
+        threads         : int, number of decoding threads
+        image           : bool, if False image is not loaded and None is yielded instead
+        frames          : list of frame names, replaces every n-th frame
+        '''
+
+        frames = self.get_frames(every_nth_frame) if frames is None else frames
+
+        if prefetch < 1:
+            for f in frames:
+                yield (f,) + self.get_frame_data(f, image)
+            return
+
+        frames = iter(frames)
+
+        # Bounded queue of pending frames, oldest first
+        queue = collections.deque()
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, threads))
+
+        def submit():
+            f = next(frames, None)
+            if f is not None:
+                queue.append((f, executor.submit(self.get_frame_data, f, image)))
+
+        try:
+            for _ in range(prefetch):
+                submit()
+
+            while queue:
+                f, future = queue.popleft()
+                # Refill before blocking on the oldest frame
+                submit()
+                yield (f,) + future.result()
+
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+class CourtMasks(collections.abc.Mapping):
+    """
+    Court feature masks of one frame. Mask is decoded (DataLoader.read_mask_court) when it is accessed
+    for the first time and kept for this frame, features which are never used are never read.
+
+    self.features   : list of features available for this frame
+    self.masks      : Dictionary with already decoded masks
+    """
+    def __init__(self, data_loader, frame, features):
+        super(CourtMasks, self).__init__()
+
+        self.data_loader    = data_loader
+        self.frame          = frame
+        self.features       = features
+
+        self.masks          = {}
+
+    def __getitem__(self, feature):
+
+        if feature not in self.masks:
+
+            if feature not in self.features:
+                raise KeyError(feature)
+
+            self.masks[feature] = self.data_loader.read_mask_court(self.frame, feature)
+
+        return self.masks[feature]
+
+    def __contains__(self, feature):
+        # Without decoding
+        return feature in self.features
+
+    def __iter__(self):
+        return iter(self.features)
+
+    def __len__(self):
+        return len(self.features)
+
+    def load(self, features):
+        '''
+        Decodes given features now, used to decode in loader threads masks which will surely be accessed.
+        '''
+
+        for f in features:
+            if f in self.features:
+                self[f]
+
 class GameHandler(object):
     """
+    mask_scale                  : int, masks are downsampled by this factor (DataLoader.mask_downsample), all image positions
+                                  are computed in full resolution image coordinates
+
+    homography_mode             : str, ['full', 'incremental'], in incremental mode keypoints are refitted only for court features
+                                  whose masks changed since their last fit
+    homography_change_thresh    : float, fraction of changed mask pixels above which court feature is refitted
+    homography_error_thresh     : float, mean reprojection error in pixels above which incremental result is dropped for full solve
+    homography_cache            : HomographyCache or None, frames with already seen court masks take keypoints and homography from it
+    fit_pyramid_levels          : int, court features are fitted on masks downsampled 2**fit_pyramid_levels times and refined
+                                  on full masks (utils.get_court_feature_fit_pyramid), 0 fits full masks
+
+    self.homography_path        : str, ['cache', 'fast', 'partial', 'full'] how homography of the current frame was computed
+    self.homography_stats       : Counter of homography paths over all frames
+    self.image_keypoints        : Dictionary with image coordinates (or None) of each court keypoint in the current frame
+
+    self.registry               : PersonRegistry, positions and state of all persons as arrays
+    self.person                 : Dictionary with Person view of each registered person, in order of registration
     """
-    def __init__(self):
+    def __init__(self, mask_scale=1, homography_mode='full', homography_change_thresh=0.05, homography_error_thresh=5., homography_cache=None, fit_pyramid_levels=0):
         super(GameHandler, self).__init__()
 
+        self.registry = PersonRegistry()
         self.person = {}
 
+        self.mask_scale = mask_scale
+
+        self.fit_pyramid_levels = fit_pyramid_levels
+
+        self.homography_mode            = homography_mode
+        self.homography_change_thresh   = homography_change_thresh
+        self.homography_error_thresh    = homography_error_thresh
+
+        # Incremental homography state, kept between frames
+        self.homography_previous        = None
+        self.homography_references      = {}
+        self.homography_fits            = {}
+        self.homography_keypoints       = {}
+        self.homography_path            = None
+        self.homography_stats           = collections.Counter()
+
+        self.homography_cache           = homography_cache
+        # (key, image keypoints, homography) added to the cache in the current frame
+        self.homography_cache_entry     = None
+
+        # (homography, its inverse)
+        self.homography_inverse         = None
+
         self.reset()   
 
     def reset(self):
@@ -111,20 +489,199 @@ class GameHandler(object):
         self.ball_possesion = None
 
         self.homography = None
+        self.image_keypoints = {}
+        self.homography_cache_entry = None
+
+        self.registry.reset()
+
+    def get_homography_config(self):
+        '''
+        Returns string with settings which change computed keypoints and homography, part of homography cache key,
+        so a cache saved with other settings is not reused.
+        '''
+
+        config = 'scale{}_pyramid{}_{}'.format(self.mask_scale, self.fit_pyramid_levels, self.homography_mode)
 
-        for p, p_value in self.person.items():
-            p_value.reset()
+        if self.homography_mode == 'incremental':
+            config += '_change{}_error{}'.format(self.homography_change_thresh, self.homography_error_thresh)
+
+        return config
 
     def compute_homography(self):
         '''
         Compute homography mapping between court on a map and image
         '''
-        
-        self.map_keypoints_ordered, self.image_keypoints_ordered = utils.get_matched_keypoints(self.masks['court'], CONFIG.COURT_KEYPOINTS)
 
-        h, status = cv2.findHomography(self.map_keypoints_ordered, self.image_keypoints_ordered)
-        
+        key, entry = None, None
+
+        if self.homography_cache is not None:
+
+            key = self.get_homography_config() + '_' + utils.get_masks_hash(self.masks['court'], utils.get_keypoint_features(CONFIG.COURT_KEYPOINTS))
+
+            entry = self.homography_cache.get(key)
+
+        if entry is not None:
+
+            self.image_keypoints, self.homography = entry
+            self.map_keypoints_ordered, self.image_keypoints_ordered = utils.match_keypoints(self.image_keypoints, CONFIG.COURT_KEYPOINTS)
+            self.homography_path = 'cache'
+
+        else:
+
+            if self.homography_mode == 'incremental':
+                self.compute_homography_incremental()
+            else:
+                self.compute_homography_full()
+
+            if key is not None:
+                self.homography_cache.put(key, self.image_keypoints, self.homography)
+                self.homography_cache_entry = (key, self.image_keypoints, self.homography)
+
+        self.homography_stats[self.homography_path] += 1
+
+        # Keypoints of every frame, cached ones included
+        missing = sum(1 for v in self.image_keypoints.values() if v is None)
+        profiling.profiler.count('keypoints_found', len(self.image_keypoints) - missing)
+        profiling.profiler.count('keypoints_none', missing)
+
+    def compute_homography_full(self):
+        '''
+        Fit all court features and compute homography from scratch
+        '''
+
+        with profiling.profiler.stage('keypoints'):
+
+            self.image_keypoints = utils.get_image_mask_keypoints(self.masks['court'], CONFIG.COURT_KEYPOINTS, self.mask_scale, pyramid_levels=self.fit_pyramid_levels)
+
+            self.map_keypoints_ordered, self.image_keypoints_ordered = utils.match_keypoints(self.image_keypoints, CONFIG.COURT_KEYPOINTS)
+
+        h = None
+
+        # Homography needs at least 4 keypoints
+        if len(self.map_keypoints_ordered[0]) >= 4:
+            with profiling.profiler.stage('homography'):
+                h, status = cv2.findHomography(self.map_keypoints_ordered, self.image_keypoints_ordered)
+
+        self.homography = h
+
+        self.homography_path = 'full'
+
+    def compute_homography_incremental(self):
+        '''
+        Compute homography seeded from previous frame.
+
+        Court feature masks are compared with masks used for their last fit. If none changed, previous homography
+        is reused (fast path). Otherwise only changed features are refitted, keypoints are intersected from current fits
+        and homography is solved with RANSAC (partial path). If its reprojection error is above threshold all features
+        are refitted (full path).
+        '''
+
+        features = utils.get_keypoint_features(CONFIG.COURT_KEYPOINTS)
+
+        signatures = {f: utils.get_mask_signature(self.masks['court'][f]) for f in features}
+
+        changed = [f for f in features if f not in self.homography_references
+            or utils.get_mask_change(self.homography_references[f], signatures[f]) > self.homography_change_thresh]
+
+        # Camera did not move
+        if not changed and self.homography_previous is not None:
+
+            self.homography = self.homography_previous
+            self.image_keypoints = self.homography_keypoints
+            self.map_keypoints_ordered, self.image_keypoints_ordered = utils.match_keypoints(self.homography_keypoints, CONFIG.COURT_KEYPOINTS)
+            self.homography_path = 'fast'
+            return
+
+        h = None
+
+        if self.homography_previous is not None and len(changed) < len(features):
+
+            with profiling.profiler.stage('keypoints'):
+
+                # Fits of unchanged features are reused
+                fits = dict(self.homography_fits)
+                fits.update(utils.get_court_feature_fits(self.masks['court'], changed, self.mask_scale, pyramid_levels=self.fit_pyramid_levels))
+
+                keypoints = utils.get_keypoints_from_fits(fits, CONFIG.COURT_KEYPOINTS)
+
+                self.map_keypoints_ordered, self.image_keypoints_ordered = utils.match_keypoints(keypoints, CONFIG.COURT_KEYPOINTS)
+
+            if len(self.map_keypoints_ordered[0]) >= 4:
+                with profiling.profiler.stage('homography'):
+                    h, status = cv2.findHomography(self.map_keypoints_ordered, self.image_keypoints_ordered, cv2.RANSAC, self.homography_error_thresh)
+
+            if utils.get_reprojection_error(h, self.map_keypoints_ordered, self.image_keypoints_ordered) > self.homography_error_thresh:
+                h = None
+            else:
+                self.homography_path = 'partial'
+
+        if h is None:
+
+            with profiling.profiler.stage('keypoints'):
+
+                fits = utils.get_court_feature_fits(self.masks['court'], features, self.mask_scale, pyramid_levels=self.fit_pyramid_levels)
+
+                keypoints = utils.get_keypoints_from_fits(fits, CONFIG.COURT_KEYPOINTS)
+
+                self.map_keypoints_ordered, self.image_keypoints_ordered = utils.match_keypoints(keypoints, CONFIG.COURT_KEYPOINTS)
+
+            if len(self.map_keypoints_ordered[0]) >= 4:
+                with profiling.profiler.stage('homography'):
+                    h, status = cv2.findHomography(self.map_keypoints_ordered, self.image_keypoints_ordered)
+
+            self.homography_path = 'full'
+            changed = features
+
         self.homography = h
+        self.image_keypoints = keypoints
+
+        # Remember what the current fits are based on
+        self.homography_previous = h
+        self.homography_fits = fits
+        self.homography_keypoints = keypoints
+        self.homography_references.update({f: signatures[f] for f in changed})
+
+    def add_person(self, person):
+        '''
+        Add person if not in the dictionary
+        '''
+
+        for p in person:
+
+            if p not in self.person:
+                self.registry.add(p)
+                self.person[p] = Person(self.registry, self.registry.index[p])
+
+    def update_playing(self, person, seen=None):
+        '''
+        Check who is playing and who is not, for a given list of players in this frame
+
+        seen : list of persons seen up to this frame, registered persons by default. Persons registered
+               in advance (pipeline.run_parallel) keep playing until they are seen
+        '''
+
+        registry = self.registry
+
+        on_court = np.zeros(len(registry.names), dtype=bool)
+        on_court[[registry.index[p] for p in person]] = True
+
+        if seen is None:
+            seen = registry.registered
+        else:
+            seen = np.isin(registry.names, list(seen))
+
+        # Player who left the court is not playing
+        registry.playing[seen & ~on_court & ~registry.referee] = False
+
+    def get_person_state(self):
+        '''
+        Returns dictionary with state of each person which changes between frames
+        '''
+        return {p: p_value.playing for p, p_value in self.person.items() if 'REFEREE' not in p}
+
+    def set_person_state(self, state):
+        for p, playing in state.items():
+            self.registry.playing[self.registry.index[p]] = playing
 
     def compute_person_position_on_image(self, person):
 
@@ -132,51 +689,104 @@ class GameHandler(object):
         For a given list of players in this frame computes pose
         '''        
 
-        # Add person if not in the dictionary
-        for p in person:
+        self.add_person(person)
 
-            if p not in self.person:
-                self.person[p] = Person(p)
+        self.update_playing(person)
 
-        # Add masks
-        for p, p_value in self.person.items():
+        registry = self.registry
 
-            # Check who is playing and who is not
-            if p not in person and 'REFEREE' not in p:
-                p_value.playing = False
+        # Masks grouped by person in one pass over mask names, centroids of all masks at once
+        centroids = utils.get_masks_centroids(self.masks['person'])
 
-            if 'REFEREE' not in p and p_value.playing == False and p in person:
-                p_value.playing
-            
-            # Update pose masks and position
-            for m, m_value in self.masks['person'].items():
+        for m, (p, m_name) in self.get_person_mask_names().items():
 
-                if p not in m:
-                    continue
+            if m_name not in registry.part_index:
+                continue
+
+            i, j = registry.index[p], registry.part_index[m_name]
+
+            mass, (y, x) = centroids[m]
+
+            # None if no position
+            if mass == 0:
+
+                mass_head, (y_head, x_head) = centroids.get('{}_pos_head'.format(p), (0, (np.nan, np.nan)))
+
+                # Assumption that head is there, estimate from head pos (for this scene it is)
+                if m_name == 'pos' and mass_head > 0:
+                    x_head, y_head = np.array((x_head, y_head))*self.mask_scale
+                    pos = (1.3*x_head + 42.1, y_head)
+                    registry.positions_image[i, j] = (pos[1], pos[0])
+                    registry.positions_image_valid[i, j] = True
+
+            else:
+                pos = np.array((y, x))*self.mask_scale
+                registry.positions_image[i, j] = (pos[1], pos[0])
+                registry.positions_image_valid[i, j] = True
+
+    def get_person_mask_names(self):
+        '''
+        Returns dictionary with person mask name as a key and (person, body part) as a value.
+        Mask names are '<person>_<body part>', person names may contain '_'.
+        '''
 
-                m_name = m.split(p + '_')[1]
+        names = {}
 
-                # None if no position
-                if np.sum(m_value) == 0:
+        for m in self.masks['person']:
 
-                    # Assumption that head is there, estimate from head pos (for this scene it is)
-                    if m_name == 'pos':
-                        x_head, y_head = ndi.center_of_mass(self.masks['person']['{}_pos_head'.format(p)])
-                        pos = (1.3*x_head + 42.1, y_head)
-                        p_value.positions_image[m_name] = np.array((pos[1], pos[0])).reshape(-1, 1, 2).astype(np.float32)
+            i = m.find('_')
 
-                else:
-                    pos = ndi.center_of_mass(m_value)
-                    p_value.positions_image[m_name] = np.array((pos[1], pos[0])).reshape(-1, 1, 2).astype(np.float32)
+            while i != -1:
+
+                if m[:i] in self.person:
+                    names[m] = (m[:i], m[i+1:])
+                    break
+
+                i = m.find('_', i + 1)
+
+        return names
 
     def compute_person_position_on_court(self):
+        '''
+        Projects image positions of all persons to the court in one transform
+        '''
 
-        for p, p_value in self.person.items():
+        registry = self.registry
 
-            if not 'pos' in p_value.positions_image:
-                continue
+        valid = registry.positions_image_valid[:, registry.part_index['pos']]
+
+        if not valid.any() or self.homography is None:
+            return
+
+        positions_image = registry.positions_image[valid, registry.part_index['pos']].reshape(-1, 1, 2)
+
+        registry.position_court[valid] = cv2.perspectiveTransform(positions_image, self.get_homography_inverse()).reshape(-1, 2)
+        registry.position_court_valid[valid] = True
+
+    def get_homography_inverse(self):
+        '''
+        Returns image to court mapping of current homography. It is inverted once per frame,
+        and not at all when homography is reused from previous frame or cache.
+        '''
+
+        if self.homography_inverse is None or self.homography_inverse[0] is not self.homography:
+            self.homography_inverse = (self.homography, np.linalg.inv(self.homography))
 
-            p_value.position_court = cv2.perspectiveTransform(p_value.positions_image['pos'], np.linalg.inv(self.homography))
+        return self.homography_inverse[1]
+
+    def get_snapshot(self, frame, masks_court=('basket_ball',)):
+        '''
+        Returns FrameSnapshot of current frame. Person registry is copied, so snapshot is not changed by reset.
+
+        masks_court : list of court masks needed for drawing, stored as bounding box crops
+        '''
+
+        registry = self.registry.copy()
+
+        masks = {m: utils.get_sparse_mask(self.masks['court'][m]) for m in masks_court if m in self.masks['court']}
+
+        return FrameSnapshot(frame, registry.get_persons(self.person), masks, self.ball_possesion, self.image_keypoints_ordered, self.homography,
+            self.image_keypoints, registry)
 
     def compute_ball_possesion(self, possesion):
         
@@ -185,37 +795,310 @@ class GameHandler(object):
         else:
             self.ball_possesion  = possesion.replace('ball_', '')
 
-class Person(object):
+class HomographyCache(object):
     """
+    LRU cache of homography results keyed by fit settings (GameHandler.get_homography_config) and hash of court
+    feature mask signatures (utils.get_masks_hash).
+    Value is (dictionary of image keypoints, homography).
+
+    size : int, maximum number of entries, least recently used are dropped
+    path : str or None, JSON file the cache is loaded from and saved to, so reruns over the same clip reuse it
     """
-    def __init__(self, ID):
-        super(Person, self).__init__()
+    def __init__(self, size=4096, path=None):
+        super(HomographyCache, self).__init__()
 
-        self.reset()
+        self.size = size
+        self.path = path
 
-        self.name = ID
+        self.entries = collections.OrderedDict()
 
-        self.number = CONFIG.PERSON_JERSEY_NUMBER[ID]
+        self.hits   = 0
+        self.misses = 0
 
-        # Player section: add team and player color
-        if 'REFEREE' in ID:
-            self.color = CONFIG.PERSON_REFEREE_COLOR
+        if self.path is not None and os.path.exists(self.path):
+            self.load()
 
-        else:
+    def get(self, key):
+
+        if key not in self.entries:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(key)
+
+        return self.entries[key]
+
+    def put(self, key, keypoints, homography):
+
+        self.entries[key] = (keypoints, homography)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def load(self):
+
+        with open(self.path) as file:
+            entries = json.load(file)
 
-            self.playing = True
+        for key, (keypoints, homography) in entries:
+            self.put(key, keypoints, np.array(homography) if homography is not None else None)
 
-            self.team, self.name = ID.split('_')
-            self.color_unique   = CONFIG.PERSON_PLAYER_COLOR[random.randrange(0,len(CONFIG.PERSON_PLAYER_COLOR))]
-            self.color_team     = CONFIG.PERSON_TEAM_COLOR_JERSEY[self.team]
-            self.color_number   = CONFIG.PERSON_TEAM_COLOR_NUMBER[self.team]
+    def save(self):
+        '''
+        Writes entries from least to most recently used.
+        '''
+
+        if self.path is None:
+            return
+
+        entries = [[key, [{k: np.asarray(v).tolist() if v is not None else None for k, v in keypoints.items()},
+            homography.tolist() if homography is not None else None]] for key, (keypoints, homography) in self.entries.items()]
+
+        with open(self.path + '.tmp', 'w') as file:
+            json.dump(entries, file)
+        os.replace(self.path + '.tmp', self.path)
+
+class FrameSnapshot(object):
+    """
+    Compact result of analysis of one frame, everything needed to draw it without masks of the whole frame.
+
+    self.frame              : Frame name
+    self.person             : Dictionary with Person views of a copy of PersonRegistry (image and court positions, colors, numbers)
+    self.masks_court        : Dictionary with utils.SparseMask of court masks needed for drawing
+    self.ball_possesion     : Person in ball possesion or None
+    self.image_keypoints    : Ordered image keypoints
+    self.homography         : Homography mapping between court on a map and image
+    self.keypoints          : Dictionary with keypoint name as a key and image coordinates (or None) as a value
+    self.registry           : PersonRegistry which person are views of
+    """
+    def __init__(self, frame, person, masks_court, ball_possesion, image_keypoints, homography, keypoints=None, registry=None):
+        super(FrameSnapshot, self).__init__()
+
+        self.frame              = frame
+        self.person             = person
+        self.masks_court        = masks_court
+        self.ball_possesion     = ball_possesion
+        self.image_keypoints    = image_keypoints
+        self.homography         = homography
+        self.keypoints          = keypoints if keypoints is not None else {}
+        self.registry           = registry if registry is not None else PersonRegistry()
+
+def interpolate_snapshots(snapshot_a, snapshot_b, alpha, frame, masks_court):
+    '''
+    Returns FrameSnapshot of a frame between two analyzed frames, alpha in (0, 1) is its relative position.
+
+    Image and court positions known in both frames and homography are interpolated linearly (constant velocity
+    between the frames), for all persons and body parts at once. Everything else is taken from the nearer frame.
+
+    masks_court : Dictionary with court masks needed for drawing of this frame
+    '''
+
+    near = snapshot_a if alpha < 0.5 else snapshot_b
+
+    a, b = snapshot_a.registry, snapshot_b.registry
+
+    # Persons registered until the later frame
+    registry = b.copy()
+
+    for name in ['playing', 'positions_image', 'positions_image_valid', 'position_court', 'position_court_valid']:
+        setattr(registry, name, getattr(near.registry, name).copy())
+
+    both = a.positions_image_valid & b.positions_image_valid
+    registry.positions_image[both] = (1 - alpha) * a.positions_image[both] + alpha * b.positions_image[both]
+
+    both = a.position_court_valid & b.position_court_valid
+    registry.position_court[both] = (1 - alpha) * a.position_court[both] + alpha * b.position_court[both]
+
+    homography = near.homography
+
+    if snapshot_a.homography is not None and snapshot_b.homography is not None:
+        homography = (1 - alpha) * snapshot_a.homography / snapshot_a.homography[2, 2] + alpha * snapshot_b.homography / snapshot_b.homography[2, 2]
+
+    keypoints = dict(near.keypoints)
+
+    for k in keypoints:
+        if snapshot_a.keypoints.get(k) is not None and snapshot_b.keypoints.get(k) is not None:
+            keypoints[k] = tuple((1 - alpha) * np.array(snapshot_a.keypoints[k]) + alpha * np.array(snapshot_b.keypoints[k]))
+
+    map_keypoints_ordered, image_keypoints_ordered = utils.match_keypoints(keypoints, CONFIG.COURT_KEYPOINTS)
+
+    return FrameSnapshot(frame, registry.get_persons(snapshot_b.person), masks_court, near.ball_possesion,
+        image_keypoints_ordered, homography, keypoints, registry)
+
+class PersonRegistry(object):
+    """
+    State of all persons as arrays with person index as the first axis, built from CONFIG.PERSON_JERSEY_NUMBER
+    (persons) and CONFIG.PERSON_POSE_COLORS (body parts). Person objects are views into it.
+
+    self.names                  : list of person names, order of person axis
+    self.parts                  : list of image position names ('pos', 'pos_<body part>'), order of part axis
+    self.index                  : Dictionary with person name as a key and index as a value
+    self.part_index             : Dictionary with image position name as a key and index as a value
+
+    self.registered             : (P,) bool, person was seen in some frame
+    self.playing                : (P,) bool, player is playing (referees always are)
+    self.positions_image        : (P, K, 2) float32, image position (x, y) of each body part
+    self.positions_image_valid  : (P, K) bool
+    self.position_court         : (P, 2) float32, position on court map
+    self.position_court_valid   : (P,) bool
+
+    self.connections            : list of (part index, part index) pairs of drawn pose lines
+    self.part_colors            : list of (part index, color) of drawn pose points
+    """
+    def __init__(self):
+        super(PersonRegistry, self).__init__()
+
+        self.names  = list(CONFIG.PERSON_JERSEY_NUMBER)
+        self.parts  = ['pos'] + ['pos_' + part for part in CONFIG.PERSON_POSE_COLORS]
+
+        self.index      = {p: i for i, p in enumerate(self.names)}
+        self.part_index = {m: j for j, m in enumerate(self.parts)}
+
+        self.connections = [(self.part_index['pos_' + l], self.part_index['pos_' + ll])
+            for l, l_value in CONFIG.PERSON_POSE_CONNECTIONS.items() for ll in l_value]
+        self.part_colors = [(self.part_index['pos_' + c], c_value) for c, c_value in CONFIG.PERSON_POSE_COLORS.items()]
+
+        n = len(self.names)
+
+        # Attributes which do not change between frames
+        self.referee        = np.array(['REFEREE' in p for p in self.names])
+        self.number         = [CONFIG.PERSON_JERSEY_NUMBER[p] for p in self.names]
+        self.color_unique   = [None] * n
+        self.color_team     = [None] * n
+        self.color_number   = [None] * n
+
+        self.registered     = np.zeros(n, dtype=bool)
+        self.playing        = np.ones(n, dtype=bool)
+
+        self.positions_image        = np.zeros((n, len(self.parts), 2), dtype=np.float32)
+        self.positions_image_valid  = np.zeros((n, len(self.parts)), dtype=bool)
+        self.position_court         = np.zeros((n, 2), dtype=np.float32)
+        self.position_court_valid   = np.zeros(n, dtype=bool)
+
+    def add(self, name):
+        '''
+        Registers person, players get team colors and random unique color.
+        '''
+
+        i = self.index[name]
+
+        if self.registered[i]:
+            return
+
+        self.registered[i] = True
+
+        if self.referee[i]:
+            self.color_unique[i] = self.color_team[i] = CONFIG.PERSON_REFEREE_COLOR
+        else:
+            team = name.split('_')[0]
+            self.color_unique[i]    = CONFIG.PERSON_PLAYER_COLOR[random.randrange(0,len(CONFIG.PERSON_PLAYER_COLOR))]
+            self.color_team[i]      = CONFIG.PERSON_TEAM_COLOR_JERSEY[team]
+            self.color_number[i]    = CONFIG.PERSON_TEAM_COLOR_NUMBER[team]
 
     def reset(self):
+        '''
+        Invalidates all positions, called after each frame.
+        '''
 
-        self.position_court     = None
-        # Dictionary with all the masks
-        self.masks              = {}
-        # Dictionary of image positions for each body part
-        self.positions_image    = {}
-        
-        self.map_keypoints_ordered, self.image_keypoints_ordered = [], []
+        self.positions_image_valid[:] = False
+        self.position_court_valid[:] = False
+
+    def copy(self):
+        '''
+        Returns copy with own position arrays, used for snapshots of a frame.
+        '''
+
+        registry = copy.copy(self)
+
+        for name in ['registered', 'playing', 'positions_image', 'positions_image_valid', 'position_court', 'position_court_valid']:
+            setattr(registry, name, getattr(self, name).copy())
+
+        return registry
+
+    def get_persons(self, names=None):
+        '''
+        Returns dictionary with Person view of given (all registered by default) persons.
+        '''
+
+        if names is None:
+            names = [p for i, p in enumerate(self.names) if self.registered[i]]
+
+        return {p: Person(self, self.index[p]) for p in names}
+
+class Person(object):
+    """
+    View of one person in PersonRegistry.
+    """
+    __slots__ = ['registry', 'index']
+
+    def __init__(self, registry, index):
+
+        self.registry   = registry
+        self.index      = index
+
+    @property
+    def name(self):
+        '''
+        Player surname, or full name of referee
+        '''
+        name = self.registry.names[self.index]
+        return name if self.registry.referee[self.index] else name.split('_')[1]
+
+    @property
+    def team(self):
+        return None if self.registry.referee[self.index] else self.registry.names[self.index].split('_')[0]
+
+    @property
+    def number(self):
+        return self.registry.number[self.index]
+
+    @property
+    def color(self):
+        return CONFIG.PERSON_REFEREE_COLOR if self.registry.referee[self.index] else None
+
+    @property
+    def color_unique(self):
+        return self.registry.color_unique[self.index]
+
+    @color_unique.setter
+    def color_unique(self, color):
+        self.registry.color_unique[self.index] = color
+
+    @property
+    def color_team(self):
+        return self.registry.color_team[self.index]
+
+    @property
+    def color_number(self):
+        return self.registry.color_number[self.index]
+
+    @property
+    def playing(self):
+        return bool(self.registry.playing[self.index])
+
+    @playing.setter
+    def playing(self, playing):
+        self.registry.playing[self.index] = playing
+
+    @property
+    def position_court(self):
+        '''
+        Position on court map as (1, 1, 2) array, None if unknown
+        '''
+
+        if not self.registry.position_court_valid[self.index]:
+            return None
+
+        return self.registry.position_court[self.index].reshape(1, 1, 2)
+
+    @property
+    def positions_image(self):
+        '''
+        Dictionary with (1, 1, 2) image position of each known body part, built on access
+        '''
+
+        registry, i = self.registry, self.index
+
+        return {m: registry.positions_image[i, j].reshape(1, 1, 2) for j, m in enumerate(registry.parts) if registry.positions_image_valid[i, j]}
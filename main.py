@@ -1,64 +1,174 @@
 # This code version is designed for prepared masks from Blender
 # python main.py --path_data '/Users/benjamin/Documents/data/basketball/2016_finals'
 # docker run -v $PWD:/temp/ jrottenberg/ffmpeg:3.2-scratch -framerate 20 -start_number 800 -i temp/%06d.png -vcodec mpeg4 -b 10000k temp/movie.mp4
+# or encode directly without intermediate png files
+# python main.py --path_data '/Users/benjamin/Documents/data/basketball/2016_finals' --output_format ffmpeg --output_path movie.mp4
 
 import argparse
 
 import game
+import decoder
 import visual
+import pipeline
+import tracking
+import profiling
 
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
     parser.add_argument("--path_data", type=str, help="Path to images, masks, list of frames.", required=True)
     parser.add_argument("--every_nth_frame", type=int, default=1, help="Analyze every n-th frame.", required=False)
+    parser.add_argument("--prefetch", type=int, default=4, help="Number of frames decoded ahead in background, 0 disables.", required=False)
+    parser.add_argument("--loader_threads", type=int, default=2, help="Number of threads decoding prefetched frames.", required=False)
+    parser.add_argument("--backend", type=str, default='png', choices=['png', 'archive'], help="Read masks from png tree or from archive packed with archive.py.", required=False)
+    parser.add_argument("--decode_slots", type=int, default=0, help="Decode frames in a separate loader process into this many shared memory slots, 0 decodes in the processing process.", required=False)
+    parser.add_argument("--workers", type=int, default=0, help="Number of worker processes, 0 processes frames in this process.", required=False)
+    parser.add_argument("--mask_downsample", type=int, default=1, help="Downsample masks by this factor at load time.", required=False)
+    parser.add_argument("--homography_mode", type=str, default='full', choices=['full', 'incremental'], help="Refit all court features every frame or only those which changed.", required=False)
+    parser.add_argument("--homography_change_thresh", type=float, default=0.05, help="Fraction of changed court mask pixels which triggers refit.", required=False)
+    parser.add_argument("--homography_error_thresh", type=float, default=5., help="Reprojection error in pixels which triggers full homography solve.", required=False)
+    parser.add_argument("--fit_pyramid_levels", type=int, default=0, help="Fit court features on masks downsampled 2^n times and refine on full masks, 0 fits full masks.", required=False)
+    parser.add_argument("--homography_cache", type=int, default=0, help="Number of homography results cached by court mask content, 0 disables.", required=False)
+    parser.add_argument("--homography_cache_path", type=str, default=None, help="JSON file homography cache is loaded from and saved to.", required=False)
+    parser.add_argument("--output_format", type=str, default='png', choices=['png', 'video', 'ffmpeg'], help="Write png sequence, video with cv2.VideoWriter or stream to ffmpeg.", required=False)
+    parser.add_argument("--output_path", type=str, default=None, help="Output directory for png, output file for video (default ../tmp, ../tmp/movie.mp4).", required=False)
+    parser.add_argument("--fps", type=int, default=20, help="Frame rate of output video.", required=False)
+    parser.add_argument("--render", type=str, default='sync', choices=['sync', 'async', 'none'], help="Draw frames after analysis, in render processes, or not at all.", required=False)
+    parser.add_argument("--render_workers", type=int, default=1, help="Number of render processes in async render mode.", required=False)
+    parser.add_argument("--render_queue", type=int, default=8, help="Maximum number of frames waiting for render in async mode.", required=False)
+    parser.add_argument("--tracking_path", type=str, default=None, help="Store per-frame positions, homography and possession in this directory.", required=False)
+    parser.add_argument("--profile", type=str, default=None, help="Time stages of the frame loop and write summary to this JSON file.", required=False)
+    parser.add_argument("--progress_every", type=int, default=0, help="Report progress with ETA every n frames, 0 disables.", required=False)
+    parser.add_argument("--keyframe_every", type=int, default=0, help="Analyze only every n-th frame and interpolate frames between, 0 analyzes all frames.", required=False)
+    parser.add_argument("--keyframe_change_thresh", type=float, default=None, help="Also analyze frames where court masks changed by this fraction since the last keyframe.", required=False)
     args = parser.parse_args()
 
+    if args.keyframe_every > 0 and args.workers > 0:
+        parser.error('Keyframe mode runs in the main process, use --workers 0')
+
+    if args.keyframe_every > 0 and args.decode_slots > 0:
+        parser.error('Keyframe mode loads court and person masks separately, use --decode_slots 0')
+
+    if args.homography_mode == 'incremental' and args.workers > 0:
+        parser.error('Incremental homography depends on the previous frame, which workers may not have processed, use --workers 0')
+
+    if args.profile:
+        profiling.profiler.enable()
+
     # -------------------------------
     # Load images, masks, etc
-    data_loader = game.DataLoader(args.path_data)
+    data_loader = game.DataLoader(args.path_data, args.backend, args.mask_downsample)
+
+    # Frames with already seen court masks skip keypoint extraction
+    homography_cache = game.HomographyCache(args.homography_cache, args.homography_cache_path) if args.homography_cache > 0 else None
 
     # Handle everything in the game
-    game_handler = game.GameHandler()
+    game_handler = game.GameHandler(args.mask_downsample, args.homography_mode, args.homography_change_thresh, args.homography_error_thresh, homography_cache, args.fit_pyramid_levels)
 
     # Prepare visulization handler
-    visual_handler = visual.VisualizationHandler()
+    visual_handler = visual.VisualizationHandler(visual.get_sink(args.output_format, args.output_path, args.fps))
+    visual_handler.set_map_court(data_loader.get_map_court())
+
+    # Tracking results of analyzed frames
+    tracking_writer = tracking.TrackingWriter(args.tracking_path) if args.tracking_path else None
+
+    progress = profiling.ProgressReporter(len(data_loader.get_frames(args.every_nth_frame)), args.progress_every)
+
+    # Drawing and encoding runs in separate processes, fed with compact snapshots of analyzed frames
+    render_queue = pipeline.RenderQueue(data_loader, visual_handler, args.render_workers, args.render_queue) if args.render == 'async' and args.workers == 0 else None
+
+    # Frames are decoded by a loader process into shared memory, images are needed only when drawn in this process or in workers
+    decode_service = None
+    if args.decode_slots > 0:
+        decode_service = decoder.DecodeService(data_loader, data_loader.get_frames(args.every_nth_frame), args.decode_slots,
+            args.render == 'sync' or (args.workers > 0 and args.render != 'none'), args.loader_threads)
+
+    # -------------------------------
+    # Frames are spread across worker processes
+    if args.workers > 0:
+
+        for f in pipeline.run_parallel(data_loader, game_handler, visual_handler, data_loader.get_frames(args.every_nth_frame), args.workers, args.render != 'none', tracking_writer, decode_service):
+            print(pipeline.get_frame_report(f, game_handler))
+
+            report = progress.update()
+            if report is not None:
+                print(report)
+
+    # -------------------------------
+    # Keyframes are analyzed, frames between them are interpolated
+    elif args.keyframe_every > 0:
+
+        for snapshot, keyframe in pipeline.iterate_keyframes(data_loader, game_handler, data_loader.get_frames(args.every_nth_frame), args.keyframe_every, args.keyframe_change_thresh):
+
+            print(pipeline.get_frame_report(snapshot.frame, game_handler) if keyframe else 'Frame {} interpolated'.format(snapshot.frame))
+
+            if tracking_writer is not None:
+                tracking_writer.add_snapshot(snapshot)
+
+            if args.render == 'sync':
+                visual_handler.write(snapshot.frame, pipeline.render_snapshot(visual_handler, data_loader, snapshot))
+
+            elif args.render == 'async':
+                render_queue.put(snapshot)
+
+            report = progress.update()
+            if report is not None:
+                print(report)
 
     # -------------------------------
     # Main frame loop
-    for f in data_loader.frames:
+    else:
+
+        if decode_service is not None:
+            frames = decode_service.iterate_frames(data_loader)
+        else:
+            frames = data_loader.iterate_frames(args.every_nth_frame, args.prefetch, args.loader_threads, args.render == 'sync')
+
+        for f, masks_court, masks_person, image in frames:
+
+            # if int(f) < 1260:
+            #     continue
+
+            pipeline.analyze_frame(game_handler, data_loader, f, masks_court, masks_person)
+
+            print(pipeline.get_frame_report(f, game_handler))
+
+            if tracking_writer is not None:
+                tracking_writer.add_snapshot(game_handler.get_snapshot(f, masks_court=()))
+
+            # -------------------------------------
+            # VIZUALIZATION
+            if args.render == 'sync':
+                pipeline.draw_frame(visual_handler, game_handler, data_loader, f, image)
+
+            elif args.render == 'async':
+                render_queue.put(game_handler.get_snapshot(f))
 
-        if not int(f) % args.every_nth_frame == 0:
-            continue
+            report = progress.update()
+            if report is not None:
+                print(report)
 
-        # if int(f) < 1260:
-        #     continue
+            # --------------------
+            game_handler.reset()
 
-        print('Frame {}'.format(f))
+    if render_queue is not None:
+        render_queue.close()
 
-        # Get all court feature masks for this frame
-        game_handler.masks['court'] = data_loader.get_masks_court(f)
-        # Compute homography mapping between court on map and image
-        game_handler.compute_homography()
-        
-        # Get person masks and compute position of each person on image
-        game_handler.masks['person'] = data_loader.get_masks_person(f)
-        game_handler.compute_person_position_on_image(data_loader.frames_person_on_court[f])
+    if decode_service is not None:
+        decode_service.close()
 
-        # Compute person court positions given h mapping
-        game_handler.compute_person_position_on_court()
+    visual_handler.sink.close()
 
-        # Ball position
-        game_handler.compute_ball_possesion(data_loader.frames_ball_posession[f])
+    # Court features decoded in this process, in worker processes and in the decode process
+    untouched = data_loader.get_untouched_court_features()
+    if untouched:
+        print('Court features not decoded (number of frames): {}'.format(untouched))
 
-        # -------------------------------------
-        # VIZUALIZATION
-        # Load image frame and clean copy of court map
-        image     = data_loader.get_frame_image(f)
-        map_court = data_loader.get_map_court()
+    if tracking_writer is not None:
+        tracking_writer.close()
 
-        visual_handler.set_image_and_map(image, map_court)
-        visual_handler.draw_and_save(f, game_handler.person, game_handler.masks['court'], game_handler.ball_possesion, game_handler.image_keypoints_ordered)
+    if homography_cache is not None:
+        homography_cache.save()
 
-        # --------------------
-        game_handler.reset()
\ No newline at end of file
+    if args.profile:
+        profiling.profiler.save(args.profile)
@@ -0,0 +1,335 @@
+# Frame processing shared by serial and multi-process runs of main.py
+
+import collections
+import multiprocessing
+import concurrent.futures
+import numpy as np
+
+import game
+import utils
+import profiling
+
+import CONFIG
+
+def analyze_frame(game_handler, data_loader, frame, masks_court, masks_person):
+    '''
+    Runs all game computations for one frame.
+    '''
+
+    # Get all court feature masks for this frame
+    game_handler.masks['court'] = masks_court
+    # Compute homography mapping between court on map and image
+    game_handler.compute_homography()
+
+    # Get person masks and compute position of each person on image
+    game_handler.masks['person'] = masks_person
+
+    with profiling.profiler.stage('positions_image'):
+        game_handler.compute_person_position_on_image(data_loader.frames_person_on_court[frame])
+
+    # Compute person court positions given h mapping
+    with profiling.profiler.stage('positions_court'):
+        game_handler.compute_person_position_on_court()
+
+    # Ball position
+    game_handler.compute_ball_possesion(data_loader.frames_ball_posession[frame])
+
+def render_frame(visual_handler, game_handler, data_loader, frame, image):
+    '''
+    Draws one analyzed frame, returns drawn image.
+    '''
+
+    # Clean court map is set once per run
+    visual_handler.set_image(image)
+
+    with profiling.profiler.stage('render'):
+        return visual_handler.draw(game_handler.person, game_handler.masks['court'], game_handler.ball_possesion, game_handler.image_keypoints_ordered)
+
+def draw_frame(visual_handler, game_handler, data_loader, frame, image):
+    '''
+    Draws and saves one analyzed frame.
+    '''
+    visual_handler.write(frame, render_frame(visual_handler, game_handler, data_loader, frame, image))
+
+def iterate_keyframes(data_loader, game_handler, frames, keyframe_every, keyframe_change_thresh=None, masks_court=('basket_ball',)):
+    '''
+    Yields (snapshot, keyframe) for every frame, in frame order. Only keyframes are analyzed, snapshots of frames
+    between them are interpolated with game.interpolate_snapshots.
+
+    Keyframe is every keyframe_every-th frame, the last frame, and, if keyframe_change_thresh is given, every frame
+    where a court feature mask changed by more than that fraction since the last keyframe (camera moved).
+    Court masks are loaded for every frame, person masks only for keyframes. Playing state and ball possesion
+    are not interpolated, they are taken from frames.txt for every frame as in the serial path.
+
+    masks_court : list of court masks needed for drawing, kept for every frame
+    '''
+
+    features = utils.get_keypoint_features(CONFIG.COURT_KEYPOINTS)
+
+    keyframe_index, keyframe_snapshot, references = None, None, {}
+
+    # Frames waiting for the next keyframe, (index, frame, court masks for drawing, playing state, ball possesion)
+    pending = []
+
+    for i, f in enumerate(frames):
+
+        masks = data_loader.get_masks_court(f)
+
+        keyframe = keyframe_index is None or i - keyframe_index >= keyframe_every or i == len(frames) - 1
+
+        if not keyframe and keyframe_change_thresh is not None:
+            keyframe = any(utils.get_mask_change(references[m], utils.get_mask_signature(masks[m])) > keyframe_change_thresh
+                for m in references if m in masks)
+
+        if not keyframe:
+            # Persons are registered and leave the court in every frame, not only in keyframes
+            game_handler.add_person(data_loader.frames_person_on_court[f])
+            game_handler.update_playing(data_loader.frames_person_on_court[f])
+            game_handler.compute_ball_possesion(data_loader.frames_ball_posession[f])
+
+            pending.append((i, f, {m: utils.get_sparse_mask(masks[m]) for m in masks_court if m in masks},
+                game_handler.registry.playing.copy(), game_handler.ball_possesion))
+            continue
+
+        analyze_frame(game_handler, data_loader, f, masks, data_loader.get_masks_person(f))
+
+        snapshot = game_handler.get_snapshot(f, masks_court)
+
+        for j, f_pending, masks_pending, playing, ball_possesion in pending:
+
+            snapshot_pending = game.interpolate_snapshots(keyframe_snapshot, snapshot, (j - keyframe_index) / (i - keyframe_index), f_pending, masks_pending)
+
+            snapshot_pending.registry.playing[:] = playing
+            snapshot_pending.ball_possesion = ball_possesion
+
+            yield snapshot_pending, False
+
+        yield snapshot, True
+
+        if keyframe_change_thresh is not None:
+            references = {m: utils.get_mask_signature(masks[m]) for m in features if m in masks}
+
+        keyframe_index, keyframe_snapshot, pending = i, snapshot, []
+
+        game_handler.reset()
+
+def render_snapshot(visual_handler, data_loader, snapshot):
+    '''
+    Draws frame from game_handler.get_snapshot, returns drawn image. Frame image is loaded here.
+    '''
+
+    with profiling.profiler.stage('load_image'):
+        visual_handler.set_image(data_loader.get_frame_image(snapshot.frame))
+
+    with profiling.profiler.stage('render'):
+        return visual_handler.draw(snapshot.person, snapshot.masks_court, snapshot.ball_possesion, snapshot.image_keypoints)
+
+# ----------------------------------
+# Worker side of multi-process run. Handlers are copied to each worker once.
+
+_worker = {}
+
+def init_worker(data_loader, game_handler, visual_handler, render=True, tracking=False, profile=False, decode_service=None):
+    _worker['data_loader']      = data_loader
+    _worker['game_handler']     = game_handler
+    _worker['visual_handler']   = visual_handler
+    _worker['render']           = render
+    _worker['tracking']         = tracking
+    _worker['decode_service']   = decode_service
+
+    # Records are sent back to the main process with every result
+    profiling.profiler.enabled  = profile
+    profiling.profiler.reset()
+
+def process_frame(task):
+    '''
+    Loads, analyzes and draws one frame in a worker. Returns frame name, homography path,
+    drawn image if it has to be written by the main process, snapshot if tracking is stored,
+    new homography cache entry, court mask statistics (game.DataLoader.court_mask_stats) and profiler records.
+
+    With decode service task holds decoder.FrameDescriptor instead of frame name, frame is read from
+    shared memory and its slot is released when the frame is done.
+    '''
+
+    frame, person_state = task
+
+    decode_service = _worker['decode_service']
+
+    if decode_service is None:
+        return process_frame_data(frame, person_state, *_worker['data_loader'].get_frame_data(frame))
+
+    descriptor = frame
+
+    try:
+        masks_court, masks_person, image = decode_service.get_frame_data(descriptor, _worker['data_loader'])
+
+        result = process_frame_data(descriptor.frame, person_state, masks_court, masks_person, image)
+
+        # Drawn image can be the frame image itself (image layout), it is sent after the slot is released
+        if result[2] is not None and image is not None and np.may_share_memory(result[2], image):
+            result = result[:2] + (result[2].copy(),) + result[3:]
+
+        return result
+
+    finally:
+        decode_service.release(descriptor)
+
+def process_frame_data(frame, person_state, masks_court, masks_person, image):
+    '''
+    Analyzes and draws one loaded frame in a worker, returns the same as process_frame.
+    '''
+
+    data_loader, game_handler, visual_handler = _worker['data_loader'], _worker['game_handler'], _worker['visual_handler']
+
+    # Person attributes which depend on previous frames are computed by the main process
+    game_handler.set_person_state(person_state)
+
+    analyze_frame(game_handler, data_loader, frame, masks_court, masks_person)
+
+    out_image, snapshot = None, None
+
+    if _worker['tracking']:
+        snapshot = game_handler.get_snapshot(frame, masks_court=())
+
+    if _worker['render']:
+
+        # Ordered sinks (video) are written by the main process
+        out_image = render_frame(visual_handler, game_handler, data_loader, frame, image)
+
+        if not visual_handler.sink.ordered:
+            visual_handler.write(frame, out_image)
+            out_image = None
+
+    cache_entry = game_handler.homography_cache_entry
+
+    game_handler.reset()
+
+    return frame, game_handler.homography_path, out_image, snapshot, cache_entry, data_loader.pop_court_mask_stats(), profiling.profiler.pop_records()
+
+def run_parallel(data_loader, game_handler, visual_handler, frames, workers, render=True, tracking_writer=None, decode_service=None):
+    '''
+    Processes frames in a pool of worker processes. Yields frame names in frame order, as they are done.
+    Frames for ordered sinks are drawn in workers and written here, in frame order.
+    Homography path of each frame is collected into game_handler.homography_stats.
+    Tracking results are appended to tracking_writer here, in frame order, new homography cache
+    entries computed by workers are added to game_handler.homography_cache and court mask statistics
+    of workers to data_loader.
+
+    Person registry (colors, jersey numbers) is created for the whole clip before workers start,
+    so every worker has the same person attributes. Playing state is computed here, frame by frame.
+
+    decode_service : decoder.DecodeService of the same frames or None, workers get frames from its shared
+                     memory slots instead of decoding them
+    '''
+
+    game_handler.add_person(data_loader.get_persons())
+
+    # Only persons seen so far can leave the court, as in the serial path where persons are registered when seen
+    person_states = []
+    seen = set()
+    for f in frames:
+        seen.update(data_loader.frames_person_on_court[f])
+        game_handler.update_playing(data_loader.frames_person_on_court[f], seen)
+        person_states.append(game_handler.get_person_state())
+
+    tasks = zip(frames, person_states)
+
+    # Frames are decoded in the same order, tasks are sent to workers as they become ready
+    if decode_service is not None:
+        tasks = zip(decode_service.iterate_descriptors(), person_states)
+
+    with multiprocessing.Pool(workers, init_worker, (data_loader, game_handler, visual_handler, render, tracking_writer is not None,
+            profiling.profiler.enabled, decode_service)) as pool:
+        for f, homography_path, out_image, snapshot, cache_entry, court_mask_stats, records in pool.imap(process_frame, tasks):
+
+            profiling.profiler.add_records(records)
+            data_loader.add_court_mask_stats(court_mask_stats)
+
+            if out_image is not None:
+                visual_handler.write(f, out_image)
+
+            if snapshot is not None:
+                tracking_writer.add_snapshot(snapshot)
+
+            # Results computed by workers are kept for the next run
+            if cache_entry is not None:
+                game_handler.homography_cache.put(*cache_entry)
+
+            game_handler.homography_path = homography_path
+            game_handler.homography_stats[homography_path] += 1
+            yield f
+
+def render_snapshot_in_worker(snapshot):
+    '''
+    Draws one snapshot in a render worker. Returns drawn image if it has to be written by the main process
+    (None otherwise) and profiler records.
+    '''
+
+    visual_handler = _worker['visual_handler']
+
+    out_image = render_snapshot(visual_handler, _worker['data_loader'], snapshot)
+
+    if not visual_handler.sink.ordered:
+        visual_handler.write(snapshot.frame, out_image)
+        out_image = None
+
+    return out_image, profiling.profiler.pop_records()
+
+class RenderQueue(object):
+    """
+    Draws and writes frame snapshots in a pool of render processes, so analysis of the next frames
+    does not wait for drawing and encoding.
+
+    At most queue_size snapshots are pending, put blocks on the oldest one when queue is full (backpressure).
+    Frames for ordered sinks are written by the main process in frame order.
+    """
+    def __init__(self, data_loader, visual_handler, workers=1, queue_size=8):
+        super(RenderQueue, self).__init__()
+
+        self.visual_handler = visual_handler
+        self.queue_size     = max(1, queue_size)
+
+        self.queue          = collections.deque()
+
+        self.executor = concurrent.futures.ProcessPoolExecutor(max(1, workers), initializer=init_worker,
+            initargs=(data_loader, None, visual_handler, True, False, profiling.profiler.enabled))
+
+    def put(self, snapshot):
+        '''
+        Adds snapshot to the queue, waits if queue is full.
+        '''
+
+        while len(self.queue) >= self.queue_size:
+            self.write_oldest()
+
+        self.queue.append((snapshot.frame, self.executor.submit(render_snapshot_in_worker, snapshot)))
+
+    def write_oldest(self):
+
+        frame, future = self.queue.popleft()
+
+        out_image, records = future.result()
+
+        profiling.profiler.add_records(records)
+
+        if out_image is not None:
+            self.visual_handler.write(frame, out_image)
+
+    def close(self):
+        '''
+        Waits for all pending snapshots and stops render processes.
+        '''
+
+        while self.queue:
+            self.write_oldest()
+
+        self.executor.shutdown()
+
+def get_frame_report(frame, game_handler):
+    '''
+    Returns one line progress report for analyzed frame.
+    '''
+
+    stats = game_handler.homography_stats
+
+    return 'Frame {} homography {} (fast path {}/{})'.format(frame, game_handler.homography_path, stats['fast'], sum(stats.values()))
@@ -0,0 +1,169 @@
+# Per-stage timing of the frame loop, enabled with main.py --profile
+# python main.py --path_data '/Users/benjamin/Documents/data/basketball/2016_finals' --profile ../tmp/profile.json --progress_every 100
+
+import os
+import json
+import time
+import contextlib
+import collections
+import numpy as np
+
+# Histogram bin edges in milliseconds
+HISTOGRAM_EDGES = [0, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, np.inf]
+
+class Profiler(object):
+    """
+    Collects wall and CPU time of named stages, bytes read and counters.
+
+    CPU time is time of the calling thread, so stages running in loader threads are measured correctly.
+    When disabled, stages are not timed and counters are not updated.
+
+    self.times      : Dictionary with stage name as a key and list of (wall, cpu) times in seconds as a value
+    self.counters   : Counter of events (bytes read, keypoints found, ...)
+    """
+    def __init__(self, enabled=False):
+        super(Profiler, self).__init__()
+
+        self.enabled = enabled
+        self.start   = time.perf_counter()
+
+        self.reset()
+
+    def enable(self):
+        '''
+        Starts collecting, time of the run is measured from here.
+        '''
+
+        self.enabled = True
+        self.start   = time.perf_counter()
+
+    def reset(self):
+        self.times      = collections.defaultdict(list)
+        self.counters   = collections.Counter()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        '''
+        Context manager timing code inside it as stage name.
+        '''
+
+        if not self.enabled:
+            yield
+            return
+
+        wall, cpu = time.perf_counter(), time.thread_time()
+
+        try:
+            yield
+        finally:
+            self.times[name].append((time.perf_counter() - wall, time.thread_time() - cpu))
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] += n
+
+    def count_file(self, path):
+        '''
+        Counts size of file read from disk.
+        '''
+        if self.enabled:
+            self.counters['bytes_read'] += os.path.getsize(path)
+
+    def pop_records(self):
+        '''
+        Returns collected times and counters and starts collecting again, used to send records from worker processes.
+        '''
+
+        records = (dict(self.times), dict(self.counters))
+
+        self.reset()
+
+        return records
+
+    def add_records(self, records):
+
+        times, counters = records
+
+        for name, values in times.items():
+            self.times[name].extend(values)
+
+        self.counters.update(counters)
+
+    def get_summary(self):
+        '''
+        Returns dictionary with statistics and histograms (milliseconds) of wall and CPU time of each stage, and counters.
+        '''
+
+        stages = {}
+
+        for name, values in self.times.items():
+
+            values = 1000 * np.array(values)
+
+            stages[name] = {'count': len(values)}
+
+            for i, clock in enumerate(['wall', 'cpu']):
+
+                stages[name][clock] = {
+                    'total_ms'  : float(np.sum(values[:, i])),
+                    'mean_ms'   : float(np.mean(values[:, i])),
+                    'p50_ms'    : float(np.percentile(values[:, i], 50)),
+                    'p90_ms'    : float(np.percentile(values[:, i], 90)),
+                    'max_ms'    : float(np.max(values[:, i])),
+                    'histogram' : np.histogram(values[:, i], HISTOGRAM_EDGES)[0].tolist()
+                }
+
+        return {
+            'elapsed_s'             : time.perf_counter() - self.start,
+            'histogram_edges_ms'    : [e if np.isfinite(e) else None for e in HISTOGRAM_EDGES],
+            'stages'                : stages,
+            'counters'              : dict(self.counters)
+        }
+
+    def save(self, path):
+
+        with open(path, 'w') as file:
+            json.dump(self.get_summary(), file, indent=4)
+
+class ProgressReporter(object):
+    """
+    Returns progress line with frame rate and estimated remaining time every n-th frame.
+    """
+    def __init__(self, total, every=100):
+        super(ProgressReporter, self).__init__()
+
+        self.total  = total
+        self.every  = every
+
+        self.done   = 0
+        self.start  = time.perf_counter()
+
+    def update(self):
+        '''
+        Counts one processed frame. Returns report or None if it is not time for one.
+        '''
+
+        self.done += 1
+
+        if self.every <= 0 or (self.done % self.every != 0 and self.done != self.total):
+            return None
+
+        elapsed = time.perf_counter() - self.start
+        fps = self.done / elapsed if elapsed > 0 else 0.
+        eta = (self.total - self.done) / fps if fps > 0 else 0.
+
+        return 'Progress {}/{} frames ({:.1f}%), {:.2f} fps, elapsed {}, ETA {}'.format(
+            self.done, self.total, 100 * self.done / max(1, self.total), fps, get_time_string(elapsed), get_time_string(eta))
+
+def get_time_string(seconds):
+    '''
+    Returns seconds as h:mm:ss.
+    '''
+
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+
+    return '{}:{:02d}:{:02d}'.format(hours, minutes, seconds)
+
+# Profiler of this process, enabled by main.py
+profiler = Profiler()
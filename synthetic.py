@@ -0,0 +1,206 @@
+# Generates synthetic clip in the layout DataLoader expects (masks tree, frames.txt, images, map_court.png)
+# from known homography of a panning camera and scripted player tracks
+# python synthetic.py --path_data ../tmp/synthetic --frames 50 --width 1280 --height 720
+
+import os
+import cv2
+import argparse
+import numpy as np
+
+import CONFIG
+
+# Size of court map in pixels (rows, columns), keypoints are in these coordinates
+MAP_SIZE = (849, 1593)
+
+# Map keypoints of the court corners and their image positions in the first frame of a 1280x720 clip
+MAP_CORNERS     = ['01', '21', '24', '04']
+IMAGE_CORNERS   = [[250, 200], [1030, 200], [1250, 650], [30, 650]]
+
+# Offsets of body part masks from person position (feet) in pixels of 1280x720 image
+PERSON_PARTS = {
+    'pos'               : (0, 0),
+    'pos_head'          : (0, -62),
+    'pos_chest'         : (0, -45),
+    'pos_shoulder_left' : (-8, -50),
+    'pos_shoulder_right': (8, -50),
+    'pos_elbow_left'    : (-11, -38),
+    'pos_elbow_right'   : (11, -38),
+    'pos_hand_left'     : (-12, -27),
+    'pos_hand_right'    : (12, -27),
+    'pos_hip_left'      : (-5, -28),
+    'pos_hip_right'     : (5, -28),
+    'pos_knee_left'     : (-6, -14),
+    'pos_knee_right'    : (6, -14),
+    'pos_foot_left'     : (-6, -2),
+    'pos_foot_right'    : (6, -2),
+}
+
+# Referees are annotated with position and head only
+REFEREE_PARTS = ['pos', 'pos_head']
+
+def get_map_point(keypoint):
+    return tuple(int(round(c)) for c in CONFIG.COURT_KEYPOINTS['values'][keypoint])
+
+def get_map_court_masks(thickness=6):
+    '''
+    Returns dictionary with mask of each court line feature drawn on court map. Line ends and 3pt arcs
+    go through CONFIG.COURT_KEYPOINTS, baskets are not drawn.
+    '''
+
+    segments = {
+        'line_court_top'    : [('01', '21')],
+        'line_court_bottom' : [('04', '24')],
+        'line_court_left'   : [('01', '04')],
+        'line_court_right'  : [('21', '24')],
+        'line_court_center' : [('11', '14')],
+        'line_foul_top'     : [('02', '06'), ('18', '22')],
+        'line_foul_bottom'  : [('03', '07'), ('19', '23')],
+        'line_foul_left'    : [('06', '07')],
+        'line_foul_right'   : [('18', '19')],
+    }
+
+    masks = {}
+
+    for f, f_segments in segments.items():
+
+        masks[f] = np.zeros(MAP_SIZE, dtype=np.uint8)
+
+        for a, b in f_segments:
+            cv2.line(masks[f], get_map_point(a), get_map_point(b), 255, thickness)
+
+    values = CONFIG.COURT_KEYPOINTS['values']
+
+    # 3pt arcs are circles centered between baskets and foul lines, through keypoints 09, 10 and 15, 16
+    y_center = (values['09'][1] + values['10'][1]) / 2
+
+    for f, x_center, keypoint in [('line_3pt_left', 223.5, '09'), ('line_3pt_right', 1369.5, '15')]:
+
+        radius = np.hypot(values[keypoint][0] - x_center, values[keypoint][1] - y_center)
+
+        masks[f] = np.zeros(MAP_SIZE, dtype=np.uint8)
+        cv2.circle(masks[f], (int(round(x_center)), int(round(y_center))), int(round(radius)), 255, thickness)
+
+        # Only the half of the circle towards center line
+        if f == 'line_3pt_left':
+            masks[f][:, :int(x_center)] = 0
+        else:
+            masks[f][:, int(x_center):] = 0
+
+    return masks
+
+def get_homography(i, width=1280, height=720, pan=2.):
+    '''
+    Returns homography mapping court map to image of i-th frame, camera pans by pan pixels per frame.
+    '''
+
+    scale = np.array([width / 1280, height / 720])
+
+    image_corners = np.array(IMAGE_CORNERS) * scale + [i * pan * scale[0], 0]
+    map_corners = np.array([CONFIG.COURT_KEYPOINTS['values'][k] for k in MAP_CORNERS])
+
+    h, status = cv2.findHomography(map_corners.astype(np.float32), image_corners.astype(np.float32))
+
+    return h
+
+def write_mask(path, frame, mask):
+    '''
+    Masks are stored as 3 channel png, as exported from Blender.
+    '''
+
+    os.makedirs(path, exist_ok=True)
+    cv2.imwrite(os.path.join(path, frame + '.png'), np.dstack([mask] * 3))
+
+def generate_clip(path_data, frames=20, width=1280, height=720, pan=2., seed=0):
+    '''
+    Writes synthetic clip into path_data. Ground truth homography of every frame (map to image) is
+    saved as homography.npy, array of shape (frames, 3, 3).
+
+    Person walks with constant velocity on court, first person leaves the frame every 7th frame.
+    Second person on court has the ball.
+    '''
+
+    path_masks = os.path.join(path_data, 'masks')
+    path_images = os.path.join(path_data, 'images')
+
+    os.makedirs(path_masks, exist_ok=True)
+    os.makedirs(path_images, exist_ok=True)
+
+    # Person masks are scaled with image, lines have similar width at every resolution
+    scale = width / 1280
+    masks_map = get_map_court_masks(max(2, int(round(6 * scale))))
+
+    map_court = np.full(MAP_SIZE + (3,), 60, dtype=np.uint8)
+    for m in masks_map.values():
+        map_court[m > 0] = 255
+
+    cv2.imwrite(os.path.join(path_data, 'map_court.png'), map_court)
+
+    persons = list(CONFIG.PERSON_JERSEY_NUMBER)
+
+    random = np.random.RandomState(seed)
+    positions = random.uniform([300, 150], [1300, 700], (len(persons), 2))
+    velocities = random.uniform(-6, 6, (len(persons), 2))
+
+    lines, homographies = [], []
+
+    for i in range(frames):
+
+        frame = '{:06d}'.format(i)
+
+        h = get_homography(i, width, height, pan)
+        homographies.append(h)
+
+        image = cv2.warpPerspective(map_court, h, (width, height))
+
+        for f in CONFIG.COURT_FEATURES:
+
+            if f in masks_map:
+                mask = np.where(cv2.warpPerspective(masks_map[f], h, (width, height)) > 127, 255, 0).astype(np.uint8)
+            else:
+                mask = np.zeros((height, width), dtype=np.uint8)
+
+            write_mask(os.path.join(path_masks, 'court', f, 'mask'), frame, mask)
+
+        person_on_court = persons if i % 7 else persons[1:]
+
+        for j, p in enumerate(persons):
+
+            if p not in person_on_court:
+                continue
+
+            x, y = cv2.perspectiveTransform((positions[j] + velocities[j] * i).reshape(1, 1, 2), h)[0, 0]
+
+            for part, (dx, dy) in PERSON_PARTS.items():
+
+                if 'REFEREE' in p and part not in REFEREE_PARTS:
+                    continue
+
+                center = (int(x + dx * scale), int(y + dy * scale))
+
+                mask = np.zeros((height, width), dtype=np.uint8)
+                cv2.circle(mask, center, max(1, int(round(3 * scale))), 255, -1)
+                write_mask(os.path.join(path_masks, 'person', p, part), frame, mask)
+
+                cv2.circle(image, center, max(1, int(round(3 * scale))), (0, 0, 200), -1)
+
+        cv2.imwrite(os.path.join(path_images, frame + '.jpg'), image)
+
+        lines.append(', '.join([frame, 'ball_' + person_on_court[1]] + person_on_court))
+
+    with open(os.path.join(path_masks, 'frames.txt'), 'w') as file:
+        file.write('\n'.join(lines))
+
+    np.save(os.path.join(path_data, 'homography.npy'), np.array(homographies))
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--path_data", type=str, help="Output path of synthetic clip.", required=True)
+    parser.add_argument("--frames", type=int, default=20, help="Number of frames.", required=False)
+    parser.add_argument("--width", type=int, default=1280, help="Image width.", required=False)
+    parser.add_argument("--height", type=int, default=720, help="Image height.", required=False)
+    parser.add_argument("--pan", type=float, default=2., help="Camera pan in pixels per frame, 0 for static camera.", required=False)
+    parser.add_argument("--seed", type=int, default=0, help="Seed of player tracks.", required=False)
+    args = parser.parse_args()
+
+    generate_clip(args.path_data, args.frames, args.width, args.height, args.pan, args.seed)
@@ -0,0 +1,228 @@
+# Columnar store of per-frame tracking results (positions, homography, possession), written during main.py run
+# python main.py --path_data '/Users/benjamin/Documents/data/basketball/2016_finals' --tracking_path ../tmp/tracking
+
+import os
+import json
+import numpy as np
+
+import game
+import utils
+import CONFIG
+
+TRACKING_VERSION = 1
+
+# Fixed column order of persons, image positions (body parts) and court keypoints,
+# persons and body parts are in the order of game.PersonRegistry
+PERSONS     = list(CONFIG.PERSON_JERSEY_NUMBER)
+POSITIONS   = ['pos'] + ['pos_' + part for part in CONFIG.PERSON_POSE_COLORS]
+KEYPOINTS   = sorted(CONFIG.COURT_KEYPOINTS['values'])
+
+class TrackingWriter(object):
+    """
+    Appends analyzed frames to a tracking store. Every field is a numpy array with frame as the first axis,
+    fields of frames_per_chunk frames are written into one chunk_XXXXX.npz file. Missing values are NaN.
+
+    frame       : (F,) str, frame name
+    playing     : (F, P) bool, person is playing (referees always are)
+    court_xy    : (F, P, 2) float32, person position on court map
+    image_xy    : (F, P, len(POSITIONS), 2) float32, image position of each body part
+    homography  : (F, 3, 3) float64, homography mapping between court on a map and image
+    keypoints   : (F, len(KEYPOINTS), 2) float32, image coordinates of court keypoints
+    possession  : (F,) int16, index of person in ball possesion, -1 if nobody
+
+    meta.json holds column names, list of chunks and person attributes (jersey number, unique color),
+    it is rewritten after every chunk so the store is readable while the run is in progress.
+    """
+    def __init__(self, path_tracking, frames_per_chunk=256):
+        super(TrackingWriter, self).__init__()
+
+        self.path_tracking      = path_tracking
+        self.frames_per_chunk   = frames_per_chunk
+
+        self.chunks = []
+        self.person = {}
+
+        self.reset_chunk()
+
+        os.makedirs(self.path_tracking, exist_ok=True)
+
+    def reset_chunk(self):
+        self.columns = {'frame': [], 'playing': [], 'court_xy': [], 'image_xy': [], 'homography': [], 'keypoints': [], 'possession': []}
+
+    def add_snapshot(self, snapshot):
+        '''
+        Appends game.FrameSnapshot of analyzed frame.
+        '''
+
+        registry = snapshot.registry
+
+        # Columns are registry arrays with invalid values replaced by NaN
+        playing     = registry.playing & registry.registered
+        court_xy    = np.where(registry.position_court_valid[:, None], registry.position_court, np.nan).astype(np.float32)
+        image_xy    = np.where(registry.positions_image_valid[:, :, None], registry.positions_image, np.nan).astype(np.float32)
+
+        for i in np.flatnonzero(registry.registered):
+
+            p = registry.names[i]
+
+            if p not in self.person:
+                self.person[p] = {'number': registry.number[i], 'color_unique': registry.color_unique[i]}
+
+        keypoints = np.full((len(KEYPOINTS), 2), np.nan, dtype=np.float32)
+
+        for i, k in enumerate(KEYPOINTS):
+            if snapshot.keypoints.get(k) is not None:
+                keypoints[i] = snapshot.keypoints[k]
+
+        homography = np.full((3, 3), np.nan) if snapshot.homography is None else snapshot.homography
+
+        possession = PERSONS.index(snapshot.ball_possesion) if snapshot.ball_possesion in PERSONS else -1
+
+        for name, value in zip(['frame', 'playing', 'court_xy', 'image_xy', 'homography', 'keypoints', 'possession'],
+                               [snapshot.frame, playing, court_xy, image_xy, homography, keypoints, possession]):
+            self.columns[name].append(value)
+
+        if len(self.columns['frame']) >= self.frames_per_chunk:
+            self.flush()
+
+    def flush(self):
+        '''
+        Writes buffered frames into new chunk and updates meta.json.
+        '''
+
+        if not self.columns['frame']:
+            return
+
+        self.chunks.append('chunk_{:05d}.npz'.format(len(self.chunks)))
+
+        np.savez(os.path.join(self.path_tracking, self.chunks[-1]),
+            frame       = np.array(self.columns['frame']),
+            playing     = np.stack(self.columns['playing']),
+            court_xy    = np.stack(self.columns['court_xy']),
+            image_xy    = np.stack(self.columns['image_xy']),
+            homography  = np.stack(self.columns['homography']).astype(np.float64),
+            keypoints   = np.stack(self.columns['keypoints']),
+            possession  = np.array(self.columns['possession'], dtype=np.int16))
+
+        self.reset_chunk()
+
+        self.write_meta()
+
+    def write_meta(self):
+
+        meta = {
+            'version'   : TRACKING_VERSION,
+            'persons'   : PERSONS,
+            'positions' : POSITIONS,
+            'keypoints' : KEYPOINTS,
+            'chunks'    : self.chunks,
+            'person'    : self.person
+        }
+
+        # Chunk is part of the store only when meta.json lists it
+        path_meta = os.path.join(self.path_tracking, 'meta.json')
+        with open(path_meta + '.tmp', 'w') as file:
+            json.dump(meta, file)
+        os.replace(path_meta + '.tmp', path_meta)
+
+    def close(self):
+
+        self.flush()
+
+        # Store without frames is still valid
+        if not self.chunks:
+            self.write_meta()
+
+class TrackingStore(object):
+    """
+    Reads tracking store written by TrackingWriter. All chunks are concatenated into one array per field.
+
+    self.persons    : list of person names, column order of person axis
+    self.positions  : list of body part names, column order of image_xy
+    self.keypoints  : list of court keypoint names, column order of keypoints
+    self.person     : Dictionary with person attributes (jersey number, unique color)
+    self.frames     : list of frame names
+    self.data       : Dictionary with field name as a key and array as a value
+    """
+    def __init__(self, path_tracking):
+        super(TrackingStore, self).__init__()
+
+        self.path_tracking = path_tracking
+
+        with open(os.path.join(self.path_tracking, 'meta.json')) as file:
+            meta = json.load(file)
+
+        if meta['version'] != TRACKING_VERSION:
+            raise ValueError('Unsupported tracking store version {}'.format(meta['version']))
+
+        self.persons    = meta['persons']
+        self.positions  = meta['positions']
+        self.keypoints  = meta['keypoints']
+        self.person     = meta['person']
+
+        chunks = []
+        for c in meta['chunks']:
+            with np.load(os.path.join(self.path_tracking, c)) as chunk:
+                chunks.append(dict(chunk))
+
+        self.data = {name: np.concatenate([c[name] for c in chunks]) for name in chunks[0]} if chunks else {}
+
+        self.frames = [str(f) for f in self.data.get('frame', [])]
+
+    def get_frame_index(self, frame):
+        return self.frames.index(frame)
+
+    def get_court_positions(self, part='pos'):
+        '''
+        Returns (F, P, 2) court positions of given body part of all persons in all frames, projected with
+        inverse of stored homographies in one call. NaN where body part or homography is missing.
+        '''
+
+        # NaN homographies stay NaN after inversion
+        homographies_inverse = np.full_like(self.data['homography'], np.nan)
+        valid = ~np.isnan(self.data['homography']).any(axis=(1, 2))
+        homographies_inverse[valid] = np.linalg.inv(self.data['homography'][valid])
+
+        return utils.project_points_batch(self.data['image_xy'][:, :, self.positions.index(part)], homographies_inverse)
+
+    def get_snapshot(self, index, masks_court=None):
+        '''
+        Returns game.FrameSnapshot of stored frame with given index, person registry is rebuilt from stored columns.
+
+        masks_court : Dictionary with court masks needed for drawing (not stored), empty by default
+        '''
+
+        data = self.data
+
+        registry = game.PersonRegistry()
+
+        person = [p for p in self.persons if p in self.person]
+
+        for p in person:
+
+            registry.add(p)
+
+            # Random colors are the same as in the analysis run
+            if self.person[p]['color_unique'] is not None:
+                registry.color_unique[registry.index[p]] = self.person[p]['color_unique']
+
+        registry.playing[:] = data['playing'][index] | registry.referee
+
+        registry.position_court_valid[:] = ~np.isnan(data['court_xy'][index, :, 0])
+        registry.position_court[:] = np.nan_to_num(data['court_xy'][index])
+
+        registry.positions_image_valid[:] = ~np.isnan(data['image_xy'][index, :, :, 0])
+        registry.positions_image[:] = np.nan_to_num(data['image_xy'][index])
+
+        keypoints   = data['keypoints'][index]
+        valid       = ~np.isnan(keypoints[:, 0])
+
+        homography = data['homography'][index]
+        if np.isnan(homography).any():
+            homography = None
+
+        possession = int(data['possession'][index])
+
+        return game.FrameSnapshot(self.frames[index], registry.get_persons(person), masks_court if masks_court is not None else {},
+            self.persons[possession] if possession >= 0 else None, keypoints[valid].reshape(1, -1, 2), homography,
+            {k: keypoints[i].tolist() if valid[i] else None for i, k in enumerate(self.keypoints)}, registry)
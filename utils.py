@@ -1,47 +1,397 @@
 import cv2
+import hashlib
 import numpy as np
 
 # ----------------------------------
 
-def get_image_mask_keypoints(masks, map_keypoints):
+def get_image_mask_keypoints(masks, map_keypoints, mask_scale=1, keypoints_subset=None, pyramid_levels=0):
     """ 
     Returns dictionary of keypoints and their location on image.
+
+    Each court feature mask is fitted once (get_court_feature_fits), keypoints are intersections of fits.
+
+    mask_scale       : int, masks are downsampled by this factor, mask size thresholds are scaled down
+                       and keypoints are returned in full resolution image coordinates
+    keypoints_subset : list, if given only these keypoints are computed
+    pyramid_levels   : int, fit on mask downsampled 2**pyramid_levels times and refine it (get_court_feature_fit_pyramid), 0 fits full mask
     """
 
-    keypoints = {}
+    pairs = {k: v for k, v in map_keypoints['pairs'].items() if keypoints_subset is None or k in keypoints_subset}
+
+    features = sorted(set(f for pair in pairs.values() for f in pair))
+
+    fits = get_court_feature_fits(masks, features, mask_scale, pyramid_levels=pyramid_levels)
 
-    for keypoint, keypoint_mask_pair in map_keypoints['pairs'].items():
+    return get_keypoints_from_fits(fits, map_keypoints, keypoints_subset)
 
-        coordinate = None
+def get_court_feature_fits(masks, features, mask_scale=1, min_mask_size=1e4, outlier_mask_thresh=10, pyramid_levels=0):
+    """ 
+    Returns dictionary with fit of each court feature: ellipse for 3pt lines and line for others, None if not found.
+    Thresholds are given for full resolution masks.
+    """
 
-        if 'line_3pt_left' in keypoint_mask_pair:
-            if '3pt' in keypoint_mask_pair[0]:
-                coordinate = get_ellipse_line_intersection_mask(masks[keypoint_mask_pair[1]], masks[keypoint_mask_pair[0]], 'left')
-            else:
-                coordinate = get_ellipse_line_intersection_mask(masks[keypoint_mask_pair[0]], masks[keypoint_mask_pair[1]], 'left')
+    fits = {}
 
-        elif 'line_3pt_right' in keypoint_mask_pair:
+    for f in features:
+        fits[f] = get_court_feature_fit(masks[f], 'ellipse' if '3pt' in f else 'line', mask_scale, min_mask_size, outlier_mask_thresh, pyramid_levels)
 
-            if '3pt' in keypoint_mask_pair[0]:
-                coordinate = get_ellipse_line_intersection_mask(masks[keypoint_mask_pair[1]], masks[keypoint_mask_pair[0]], 'right')
-            else:
-                coordinate = get_ellipse_line_intersection_mask(masks[keypoint_mask_pair[0]], masks[keypoint_mask_pair[1]], 'right')
+    return fits
 
-        else:
+def get_court_feature_fit(mask, shape, mask_scale=1, min_mask_size=1e4, outlier_mask_thresh=10, pyramid_levels=0):
+    """ 
+    Fits line or ellipse to a mask, returns it in full resolution image coordinates.
+
+    line    : (vx, vy, x, y) as cv2.fitLine
+    ellipse : ((xc, yc), (MA, ma), angle) as cv2.fitEllipse
+
+    Mask is thresholded and its contours are extracted only inside its bounding box.
+    With pyramid_levels > 0 mask is fitted coarse to fine (get_court_feature_fit_pyramid), if that fails
+    (e.g. line thinner than 2**pyramid_levels pixels disappears on the coarse level) full mask is fitted.
+    """
+
+    if pyramid_levels > 0:
+
+        fit = get_court_feature_fit_pyramid(mask, shape, mask_scale, min_mask_size, outlier_mask_thresh, pyramid_levels)
+
+        if fit is not None:
+            return fit
+
+    # Thresholds should be much higer if predicting masks
+
+    area = 1. / mask_scale**2
+
+    if mask.dtype != np.uint8:
+        mask = mask.astype(np.uint8)
+
+    x, y, w, h = cv2.boundingRect(mask)
+
+    if w == 0 or h == 0:
+        return None
+
+    # Keep one pixel of background around the object, contours are the same as on the full mask
+    x0, y0 = max(x - 1, 0), max(y - 1, 0)
+    x1, y1 = min(x + w + 1, mask.shape[1]), min(y + h + 1, mask.shape[0])
+    crop = mask[y0:y1, x0:x1]
+
+    if np.sum(crop) < min_mask_size*area:
+        return None
+
+    _,thresh = cv2.threshold(crop, 0.5, 255, cv2.THRESH_BINARY)
+
+    contours,_ = cv2.findContours(thresh, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE, offset=(x0, y0))
+
+    # Downsampled lines can be one pixel thin, their area and number of contour points are counted in pixels.
+    # Full resolution masks keep polygon area and 5 points, which drop small speckles
+    if mask_scale > 1:
+        contours = np.array([cc for c in contours if get_contour_pixel_area(c)>outlier_mask_thresh*area for cc in c])
+        min_points = 5 if shape == 'ellipse' else 2
+    else:
+        contours = np.array([cc for c in contours if cv2.contourArea(c)>outlier_mask_thresh*area for cc in c])
+        min_points = 5
+
+    if len(contours) < min_points:
+        return None
+
+    contours = contours.astype(np.float32)*mask_scale
+
+    if shape == 'ellipse':
+        return cv2.fitEllipse(contours)
+
+    [vx,vy,x,y] = cv2.fitLine(contours, cv2.DIST_L2, 0,0.01,0.01)
+
+    return vx[0], vy[0], x[0], y[0]
+
+def get_contour_pixel_area(contour):
+    """ 
+    Returns number of pixels inside contour, including the contour. Area of the polygon through pixel centers
+    (cv2.contourArea) is 0 for lines one pixel thin, as in downsampled masks.
+    """
+
+    return cv2.contourArea(contour) + cv2.arcLength(contour, True) / 2 + 1
+
+def get_court_feature_fit_pyramid(mask, shape, mask_scale=1, min_mask_size=1e4, outlier_mask_thresh=10, levels=2, band=None, max_points=1000):
+    """ 
+    Coarse to fine fit of line or ellipse to a mask, returns it as get_court_feature_fit.
+
+    Contours are extracted and fitted on every 2**levels-th pixel of the mask, lines thinner than 2**levels pixels
+    can break or disappear there and None is returned. The fit is refined on the full resolution mask with calipers: profiles along the normal of the coarse
+    fit, through the coarse contour points, give both edges of the feature. Only pixels on the profiles are read and
+    at most max_points edges are fitted.
+
+    band        : int, half length of the profiles in mask pixels, 4 * 2**levels by default
+    """
+
+    scale = 2**levels
+
+    if band is None:
+        band = 4 * scale
+
+    area = 1. / mask_scale**2
+
+    coarse = np.ascontiguousarray(mask[::scale, ::scale])
+
+    if coarse.dtype != np.uint8:
+        coarse = coarse.astype(np.uint8)
+
+    x, y, w, h = cv2.boundingRect(coarse)
+
+    if w == 0 or h == 0:
+        return None
+
+    # Keep one pixel of background around the object as in get_court_feature_fit
+    x0, y0 = max(x - 1, 0), max(y - 1, 0)
+    crop = cv2.copyMakeBorder(coarse[y:y + h, x:x + w], y - y0, 1, x - x0, 1, cv2.BORDER_CONSTANT, value=0)
+
+    if np.sum(crop) * scale**2 < min_mask_size*area:
+        return None
+
+    _,thresh = cv2.threshold(crop, 0.5, 255, cv2.THRESH_BINARY)
+
+    contours,_ = cv2.findContours(thresh, cv2.RETR_LIST, cv2.CHAIN_APPROX_NONE, offset=(x0, y0))
+
+    # Coarse lines can be one pixel thin
+    contours = [c for c in contours if get_contour_pixel_area(c) * scale**2 > outlier_mask_thresh*area]
+
+    if not contours:
+        return None
+
+    # Mask coordinates of coarse contour points
+    points = (np.concatenate(contours).reshape(-1, 2) * scale).astype(np.float32)
+
+    if len(points) < 5:
+        return None
+
+    # Foot of each coarse point on the coarse fit and normal of the fit there
+    if shape == 'ellipse':
+
+        (xc, yc), (ma, mb), angle = cv2.fitEllipse(points)
+
+        a, b = ma / 2, mb / 2
+
+        if a <= 0 or b <= 0:
+            return None
+
+        c, s = np.cos(np.radians(angle)), np.sin(np.radians(angle))
+        rotation = np.array([[c, -s], [s, c]])
+
+        local = (points - [xc, yc]) @ rotation
+        theta = np.arctan2(local[:, 1] / b, local[:, 0] / a)
+
+        feet = np.stack([a * np.cos(theta), b * np.sin(theta)], axis=-1) @ rotation.T + [xc, yc]
+        normals = np.stack([b * np.cos(theta), a * np.sin(theta)], axis=-1) @ rotation.T
+        normals /= np.linalg.norm(normals, axis=1, keepdims=True)
+
+    else:
+
+        [vx,vy,x,y] = cv2.fitLine(points, cv2.DIST_L2, 0,0.01,0.01)
+
+        direction = np.array([vx[0], vy[0]])
 
-            coordinate = get_two_line_intersection_mask(masks[keypoint_mask_pair[0]], masks[keypoint_mask_pair[1]])
+        feet = [x[0], y[0]] + np.outer((points - [x[0], y[0]]) @ direction, direction)
+        normals = np.tile([-direction[1], direction[0]], (len(feet), 1))
+
+    # Points on both edges of the feature have the same foot
+    _, unique = np.unique(np.round(feet).astype(np.int64) @ [1 << 32, 1], return_index=True)
+    unique = np.sort(unique)[::max(1, int(np.ceil(2 * len(unique) / max_points)))]
+
+    feet, normals = feet[unique], normals[unique]
+
+    offsets = np.arange(-band, band + 1)
+
+    profiles = np.rint(feet[:, None] + offsets[None, :, None] * normals[:, None]).astype(np.int32)
+
+    inside = (profiles[..., 0] >= 0) & (profiles[..., 0] < mask.shape[1]) & (profiles[..., 1] >= 0) & (profiles[..., 1] < mask.shape[0])
+
+    on = np.zeros(inside.shape, dtype=bool)
+    on[inside] = mask[profiles[..., 1][inside], profiles[..., 0][inside]] > 0.5
+
+    # First and last mask pixel of each profile
+    rows = np.flatnonzero(np.any(on, axis=1))
+
+    first = np.argmax(on[rows], axis=1)
+    last = on.shape[1] - 1 - np.argmax(on[rows, ::-1], axis=1)
+
+    edges = np.concatenate([profiles[rows, first], profiles[rows, last]])
+
+    if len(edges) < 5:
+        return None
+
+    edges = edges.astype(np.float32)*mask_scale
+
+    if shape == 'ellipse':
+        return cv2.fitEllipse(edges)
+
+    [vx,vy,x,y] = cv2.fitLine(edges, cv2.DIST_L2, 0,0.01,0.01)
+
+    return vx[0], vy[0], x[0], y[0]
+
+def get_keypoints_from_fits(fits, map_keypoints, keypoints_subset=None):
+    """ 
+    Returns dictionary of keypoints as intersections of fitted court features, None if there is no intersection.
+    """
+
+    features = get_keypoint_features(map_keypoints)
+
+    keypoints_array, valid = get_keypoints_batch(get_court_fits_array(fits, features), map_keypoints, features)
+
+    keypoints = {}
+
+    for i, (keypoint, keypoint_mask_pair) in enumerate(map_keypoints['pairs'].items()):
+
+        if keypoints_subset is not None and keypoint not in keypoints_subset:
+            continue
+
+        if not valid[i]:
+            coordinate = None
+        elif '3pt' in keypoint_mask_pair[0] or '3pt' in keypoint_mask_pair[1]:
+            coordinate = tuple(keypoints_array[i])
+        else:
+            coordinate = [int(c) for c in keypoints_array[i]]
 
         keypoints.update({keypoint: coordinate})
 
     return keypoints
 
-def get_matched_keypoints(masks, map_keypoints):
+def get_keypoint_features(map_keypoints):
+    """ 
+    Returns sorted list of court features used by keypoints.
+    """
+    return sorted(set(f for pair in map_keypoints['pairs'].values() for f in pair))
+
+def get_court_fits_array(fits, features):
+    """ 
+    Returns array (len(features), 5) of fit parameters in given feature order.
+    Line is (vx, vy, x, y, nan), ellipse is (xc, yc, MA, ma, angle), missing fit is all nan.
+    """
+
+    fits_array = np.full((len(features), 5), np.nan)
+
+    for i, f in enumerate(features):
+
+        if fits.get(f) is None:
+            continue
+
+        if '3pt' in f:
+            (xc, yc), (MA, ma), angle = fits[f]
+            fits_array[i] = xc, yc, MA, ma, angle
+        else:
+            fits_array[i, :4] = fits[f]
+
+    return fits_array
+
+def get_keypoints_batch(fits_array, map_keypoints, features):
+    """ 
+    Returns intersections of all keypoint pairs for any number of frames at once.
+
+    fits_array : array (..., len(features), 5) of fit parameters, see get_court_fits_array
+    features   : list of court features, order of fits_array
+
+    Returns keypoints (..., n_keypoints, 2) in map_keypoints['pairs'] order, line-line intersections truncated
+    to integer pixels, and validity (..., n_keypoints), False for parallel lines, missing fits and no real roots.
+    """
+
+    # Per pair: line feature, other feature (line or 3pt ellipse), which root of ellipse
+    index_line, index_other, is_ellipse, root_right = [], [], [], []
+
+    for pair in map_keypoints['pairs'].values():
+
+        if '3pt' in pair[0] or '3pt' in pair[1]:
+            line, other = (pair[1], pair[0]) if '3pt' in pair[0] else (pair[0], pair[1])
+        else:
+            line, other = pair
+
+        index_line.append(features.index(line))
+        index_other.append(features.index(other))
+        is_ellipse.append('3pt' in other)
+        # Take right point of left side and left point of right side
+        root_right.append('line_3pt_left' in pair)
+
+    is_ellipse, root_right = np.array(is_ellipse), np.array(root_right)
+
+    fits_array = np.asarray(fits_array, dtype=np.float64)
+    line = fits_array[..., index_line, :]
+    other = fits_array[..., index_other, :]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+
+        points_lines, valid_lines = get_two_line_intersection_batch(line[..., :4], other[..., :4])
+        points_ellipse, valid_ellipse = get_ellipse_line_intersection_batch(line[..., :4], other, root_right)
+
+    keypoints = np.where(is_ellipse[..., None], points_ellipse, np.trunc(points_lines))
+    valid = np.where(is_ellipse, valid_ellipse, valid_lines)
+
+    return keypoints, valid
+
+def get_two_line_intersection_batch(line_1, line_2):
+    """ 
+    Returns intersections (..., 2) of lines (..., 4) given as (vx, vy, x, y) and validity (...),
+    False for parallel lines and nan parameters.
+    """
+
+    # Homogeneous line through (x, y) and (x + vx, y + vy)
+    def homogeneous(line):
+        vx, vy, x, y = np.moveaxis(line, -1, 0)
+        return np.stack([y - (y + vy), (x + vx) - x, x*(y + vy) - y*(x + vx)], axis=-1)
+
+    x, y, z = np.moveaxis(np.cross(homogeneous(line_1), homogeneous(line_2)), -1, 0)
+
+    valid = (z != 0) & np.isfinite(z)
+
+    return np.stack([x/z, y/z], axis=-1), valid
+
+def get_ellipse_line_intersection_batch(line, ellipse, root_right):
+    """ 
+    Returns intersections (..., 2) of lines (..., 4) given as (vx, vy, x, y) with ellipses (..., 5) given as
+    (xc, yc, MA, ma, angle) and validity (...), False for no real root and nan parameters.
+
+    root_right : bool array (...), take root with larger x (+sqrt), otherwise smaller x
+    """
+
+    vx, vy, x, y = np.moveaxis(line, -1, 0)
+
+    # y = m*x + n 
+    m = vy/vx
+    n = y - m*x
+
+    xc, yc, MA, ma, angle = np.moveaxis(ellipse, -1, 0)
+
+    a = ma/2
+    b = MA/2
+    angle = angle*np.pi/180 - np.pi/2
+    cos = np.cos(angle)
+    sin = np.sin(angle)
+
+    E1 = (cos+m*sin)/a
+    E2 = ((n-yc)*sin - xc*cos)/a
+    E3 = (sin-m*cos)/b
+    E4 = ((n-yc)*cos + xc*sin)/b
+
+    A = E1**2 + E3**2
+    B = 2*(E1*E2 - E3*E4)
+    C = E2**2 + E4**2 - 1
+
+    root = np.sqrt(B**2 - 4*A*C)
+    x_root = (-B + np.where(root_right, root, -root))/(2*A)
+    y_root = m*x_root + n
+
+    points = np.stack([x_root, y_root], axis=-1)
+
+    return points, np.all(np.isfinite(points), axis=-1)
+
+def get_matched_keypoints(masks, map_keypoints, mask_scale=1):
     """ 
     Returns ordered list of keypoint coordinates on a map and image 
     """
 
     # Extract image keypoints from the list of image court masks
-    image_keypoints = get_image_mask_keypoints(masks, map_keypoints)
+    image_keypoints = get_image_mask_keypoints(masks, map_keypoints, mask_scale)
+
+    return match_keypoints(image_keypoints, map_keypoints)
+
+def match_keypoints(image_keypoints, map_keypoints):
+    """ 
+    Returns ordered list of keypoint coordinates on a map and image for dictionary of image keypoints
+    """
 
     # Here comes keypoints image map matching
     map_keypoints_ordered, image_keypoints_ordered = [], []
@@ -56,6 +406,197 @@ def get_matched_keypoints(masks, map_keypoints):
 
     return np.array([map_keypoints_ordered]), np.array([image_keypoints_ordered])
 
+def get_reprojection_error(homography, map_keypoints_ordered, image_keypoints_ordered):
+    """ 
+    Returns mean distance in pixels between image keypoints and map keypoints projected with homography
+    """
+
+    if homography is None or len(map_keypoints_ordered[0]) == 0:
+        return np.inf
+
+    projected = cv2.perspectiveTransform(map_keypoints_ordered.astype(np.float64), homography)
+
+    return np.mean(np.linalg.norm(projected - image_keypoints_ordered, axis=2))
+
+def project_points_batch(points, homographies):
+    """ 
+    Returns points projected with per-frame homographies in one call, for offline analysis of whole clips.
+
+    points       : (F, ..., 2) array, e.g. (frames, persons, 2) positions, NaN for missing points
+    homographies : (F, 3, 3) array, homography of each frame, np.linalg.inv(homographies) maps image to court
+
+    Missing points and frames without homography (NaN) give NaN.
+    """
+
+    points = np.asarray(points, dtype=np.float64)
+
+    shape = points.shape
+    points = points.reshape(shape[0], -1, 2)
+
+    projected = np.einsum('fij,fpj->fpi', homographies[:, :, :2], points) + homographies[:, None, :, 2]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        projected = projected[..., :2] / projected[..., 2:]
+
+    return projected.reshape(shape)
+
+def get_mask_signature(mask, step=4):
+    """ 
+    Returns cheap binary signature of a mask, every step-th row and column
+    """
+    return mask[::step, ::step] > 0
+
+def get_masks_hash(masks, features, step=4):
+    """ 
+    Returns hex digest of signatures of given masks, identical for frames whose masks have the same signatures
+    """
+
+    digest = hashlib.sha1()
+
+    for f in sorted(features):
+
+        digest.update(f.encode())
+
+        if f not in masks:
+            continue
+
+        signature = get_mask_signature(masks[f], step)
+
+        digest.update(str(signature.shape).encode())
+        digest.update(np.packbits(signature).tobytes())
+
+    return digest.hexdigest()
+
+def get_mask_change(signature_1, signature_2):
+    """ 
+    Returns fraction of changed pixels between two mask signatures, relative to their union
+    """
+
+    union = np.count_nonzero(signature_1 | signature_2)
+
+    if union == 0:
+        return 0.
+
+    return np.count_nonzero(signature_1 ^ signature_2) / union
+
+# ----------------------------------
+
+class SparseMask(object):
+    """
+    Mask stored as bounding box and cropped bitmap.
+
+    self.shape : shape of the full mask
+    self.y     : top row of bounding box
+    self.x     : left column of bounding box
+    self.crop  : uint8 mask inside bounding box, size 0 for empty mask
+    """
+    def __init__(self, shape, y, x, crop):
+        super(SparseMask, self).__init__()
+
+        self.shape  = tuple(shape)
+        self.y      = y
+        self.x      = x
+        self.crop   = crop
+
+    def to_dense(self):
+        '''
+        Returns full size uint8 mask.
+        '''
+
+        mask = np.zeros(self.shape, dtype=np.uint8)
+
+        h, w = self.crop.shape
+        mask[self.y:self.y+h, self.x:self.x+w] = self.crop
+
+        return mask
+
+def downsample_sparse_mask(mask, n, max_pool=False):
+    """ 
+    Returns SparseMask downsampled by factor n, the same samples as full size mask[::n, ::n].
+
+    max_pool : bool, samples are maximum of n x n neighbourhood as game.DataLoader.downsample_mask with max_pool
+    """
+
+    y0, x0, crop = mask.y, mask.x, mask.crop
+
+    if max_pool and crop.size > 0:
+        # Odd kernel centered on the sampled pixel, crop grows by its radius (but not over the mask) so the dilation is complete
+        size = n + 1 - n % 2
+        r = size // 2
+
+        top, left = min(r, y0), min(r, x0)
+        bottom = min(r, mask.shape[0] - y0 - crop.shape[0])
+        right = min(r, mask.shape[1] - x0 - crop.shape[1])
+
+        crop = cv2.copyMakeBorder(crop, top, bottom, left, right, cv2.BORDER_CONSTANT, value=0)
+        crop = cv2.dilate(crop, np.ones((size, size), dtype=np.uint8))
+        y0, x0 = y0 - top, x0 - left
+
+    # First sampled row and column inside bounding box, in downsampled coordinates
+    y, x = -(-y0 // n), -(-x0 // n)
+
+    crop = np.ascontiguousarray(crop[y*n-y0::n, x*n-x0::n])
+
+    return SparseMask((-(-mask.shape[0] // n), -(-mask.shape[1] // n)), y, x, crop)
+
+def get_sparse_mask(mask):
+    """ 
+    Returns SparseMask of a full size mask.
+    """
+
+    if mask.dtype != np.uint8:
+        mask = mask.astype(np.uint8)
+
+    x, y, w, h = cv2.boundingRect(mask)
+
+    return SparseMask(mask.shape, y, x, mask[y:y+h, x:x+w].copy())
+
+# ----------------------------------
+
+def get_masks_centroids(masks):
+    """ 
+    Returns dictionary with (mass, center of mass) of each mask. Mass is sum of mask values as np.sum,
+    center of mass is (row, column) as ndi.center_of_mass, (nan, nan) for empty mask.
+
+    Each mask is reduced to its bounding box and mass and centroid are read from image moments of the crop,
+    so work scales with the size of the object and not with the size of the frame. Masks can be SparseMask.
+    """
+
+    centroids = {}
+
+    for m, m_value in masks.items():
+
+        # Crop of sparse mask is already (almost) its bounding box
+        if isinstance(m_value, SparseMask):
+            y_offset, x_offset, m_value = m_value.y, m_value.x, m_value.crop
+        else:
+            y_offset, x_offset = 0, 0
+
+        if m_value.size == 0:
+            centroids[m] = (0, (np.nan, np.nan))
+            continue
+
+        if m_value.dtype != np.uint8:
+            m_value = m_value.astype(np.uint8)
+
+        x, y, w, h = cv2.boundingRect(m_value)
+
+        if w == 0 or h == 0:
+            centroids[m] = (0, (np.nan, np.nan))
+            continue
+
+        moments = cv2.moments(m_value[y:y+h, x:x+w])
+
+        if moments['m00'] == 0:
+            centroids[m] = (0, (np.nan, np.nan))
+            continue
+
+        y, x = y + y_offset, x + x_offset
+
+        centroids[m] = (moments['m00'], (y + moments['m01']/moments['m00'], x + moments['m10']/moments['m00']))
+
+    return centroids
+
 # ----------------------------------
 
 def get_two_line_intersection_analytical(a1, a2, b1, b2):
@@ -75,33 +616,13 @@ def get_two_line_intersection_analytical(a1, a2, b1, b2):
         return [float('inf'), float('inf')]
     return [int(x/z), int(y/z)]
 
-def get_two_line_intersection_mask(mask_1, mask_2, min_mask_size=1e4, outlier_mask_thresh=10):
+def get_two_line_intersection_fit(line_1, line_2):
     """ 
-    For two masks, fits line and find their intersection.
+    For two fitted lines (vx, vy, x, y) find their intersection.
     """
 
-    # Thresholds should be much higer if predicting masks
-
-    if np.sum(mask_1)<min_mask_size or np.sum(mask_2)<min_mask_size:
-        return None
-
-    _,thresh_1 = cv2.threshold(mask_1, 0.5, 255, cv2.THRESH_BINARY)
-    _,thresh_2 = cv2.threshold(mask_2, 0.5, 255, cv2.THRESH_BINARY)
-
-    contours_1,_ = cv2.findContours(cv2.convertScaleAbs(thresh_1), 1, 2)
-    contours_2,_ = cv2.findContours(cv2.convertScaleAbs(thresh_2), 1, 2)
-
-    contours_1 = np.array([cc for c in contours_1 if cv2.contourArea(c)>outlier_mask_thresh for cc in c])
-    contours_2 = np.array([cc for c in contours_2 if cv2.contourArea(c)>outlier_mask_thresh for cc in c])
-
-    if len(contours_1) < 5 or len(contours_2) < 5:
-        return None
-
-    [vx_1,vy_1,x_1,y_1] = cv2.fitLine(contours_1, cv2.DIST_L2, 0,0.01,0.01)
-    [vx_2,vy_2,x_2,y_2] = cv2.fitLine(contours_2, cv2.DIST_L2, 0,0.01,0.01)
-
-    vx_1,vy_1,x_1,y_1 = vx_1[0],vy_1[0],x_1[0],y_1[0]
-    vx_2,vy_2,x_2,y_2 = vx_2[0],vy_2[0],x_2[0],y_2[0]
+    vx_1,vy_1,x_1,y_1 = line_1
+    vx_2,vy_2,x_2,y_2 = line_2
 
     p1_0 = [x_1, y_1]
     p1_1 = [x_1 + vx_1, y_1 + vy_1]
@@ -112,6 +633,19 @@ def get_two_line_intersection_mask(mask_1, mask_2, min_mask_size=1e4, outlier_ma
 
     return intersection
 
+def get_two_line_intersection_mask(mask_1, mask_2, min_mask_size=1e4, outlier_mask_thresh=10):
+    """ 
+    For two masks, fits line and find their intersection.
+    """
+
+    line_1 = get_court_feature_fit(mask_1, 'line', min_mask_size=min_mask_size, outlier_mask_thresh=outlier_mask_thresh)
+    line_2 = get_court_feature_fit(mask_2, 'line', min_mask_size=min_mask_size, outlier_mask_thresh=outlier_mask_thresh)
+
+    if line_1 is None or line_2 is None:
+        return None
+
+    return get_two_line_intersection_fit(line_1, line_2)
+
 # ----------------------------------
 
 def get_elipse_line_intersection_analytical(ellipse, line_m, line_n):
@@ -143,44 +677,19 @@ def get_elipse_line_intersection_analytical(ellipse, line_m, line_n):
 
     return {'left':(x2[0],y2[0]), 'right':(x1[0],y1[0])}
 
-def get_ellipse_line_intersection_mask(mask_1, mask_2, side, min_mask_size=1e4, outlier_mask_thresh_line=10, outlier_mask_thresh_ellipse=10):
-    # Thresholds should be much higer if predicting masks
-
-    if np.sum(mask_1)<min_mask_size or np.sum(mask_2)<min_mask_size:
-        return None
-
-    _,thresh_1 = cv2.threshold(mask_1, 0.5, 255, cv2.THRESH_BINARY)
-    _,thresh_2 = cv2.threshold(mask_2, 0.5, 255, cv2.THRESH_BINARY)
-
-    contours_1,_ = cv2.findContours(cv2.convertScaleAbs(thresh_1), 1, 2)
-    contours_2,_ = cv2.findContours(cv2.convertScaleAbs(thresh_2), 1, 2)
-
-    contours_1 = np.array([cc for c in contours_1 if cv2.contourArea(c)>outlier_mask_thresh_line for cc in c])
-    contours_2 = np.array([cc for c in contours_2 if cv2.contourArea(c)>outlier_mask_thresh_ellipse for cc in c])
+def get_ellipse_line_intersection_fit(line, ellipse, side):
+    """ 
+    For fitted line (vx, vy, x, y) and ellipse find their intersection on given side of 3pt line.
+    """
 
-    # ----------------------------
-    # Line part
-    [vx_1,vy_1,x_1,y_1] = cv2.fitLine(contours_1, cv2.DIST_L2,0,0.01,0.01)
+    vx_1,vy_1,x_1,y_1 = line
 
     # y = m*x + n 
     m = vy_1/vx_1
     n = y_1 - m*x_1
 
-    # ----------------------------
-    # Ellipse part
-    ellipse = cv2.fitEllipse(contours_2)
-
     # Intersection
-    intersections = get_elipse_line_intersection_analytical(ellipse, m, n)
-
-    # DEBUG
-    # cv2.ellipse(thresh_2, ellipse, (255,255,0), 1)
-    # cv2.ellipse(thresh_2, ellipses[1], (255,255,0), 1)
-    # cv2.circle(thresh_2, (int(ellipses[0][0][0]),int(ellipses[0][0][1])), 2, (255,0,0), 25)
-    # cv2.circle(thresh_2, (x2,y2), 2, (255,0,0), 25)
-    # cv2.circle(thresh_2, (x_l_new,y_l_new), 2, (100,0,0), 5)
-    # cv2.line(thresh_2,(cols-1,righty_1),(0,lefty_1),(255,255,0),1)
-    # cv2.imwrite('test.png', thresh_2)
+    intersections = get_elipse_line_intersection_analytical(ellipse, np.array([m]), np.array([n]))
 
     # Take right point of left side
     if side == 'left':
@@ -194,6 +703,19 @@ def get_ellipse_line_intersection_mask(mask_1, mask_2, side, min_mask_size=1e4,
     else:
         return intersection
 
+def get_ellipse_line_intersection_mask(mask_1, mask_2, side, min_mask_size=1e4, outlier_mask_thresh_line=10, outlier_mask_thresh_ellipse=10):
+    """ 
+    For line mask and 3pt line mask, fits line and ellipse and find their intersection.
+    """
+
+    line = get_court_feature_fit(mask_1, 'line', min_mask_size=min_mask_size, outlier_mask_thresh=outlier_mask_thresh_line)
+    ellipse = get_court_feature_fit(mask_2, 'ellipse', min_mask_size=min_mask_size, outlier_mask_thresh=outlier_mask_thresh_ellipse)
+
+    if line is None or ellipse is None:
+        return None
+
+    return get_ellipse_line_intersection_fit(line, ellipse, side)
+
 # ----------------------------------
 # NOT USED AT THE MOMENT
 # def get_contour_extremes(img):
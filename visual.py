@@ -1,6 +1,11 @@
+import os
 import cv2
-import numpy as np
 import random
+import subprocess
+import numpy as np
+
+import utils
+import profiling
 
 import CONFIG
 
@@ -9,21 +14,101 @@ class VisualizationHandler(object):
     Handler for drawing
 
     """
-    def __init__(self):
+    def __init__(self, sink=None, map_scale_percent=40):
         super(VisualizationHandler, self).__init__()
         
         self.image      = None
         self.map_court  = None
         self.dashboard  = {}
 
+        # Clean court map, loaded once, and its scaled copies for each layout
+        self.map_court_base     = None
+        self.map_court_scaled   = {}
+        # Size of court map in image_map layout, percent of original size
+        self.map_scale_percent  = map_scale_percent
+        # Scale of map currently drawn on
+        self.map_scale          = 1.
+
+        # Text sizes of jersey numbers for each text scale
+        self.text_sizes = {}
+
+        # Output image of image_map layout, reused between frames
+        self.canvas     = None
+
+        # Where drawn frames go, see get_sink
+        self.sink       = sink if sink is not None else PngSequenceSink('../tmp')
+
     def set_image_and_map(self, image, map_court):
         '''
         Used for (re)loading image and map
 
         '''
 
+        self.set_image(image)
+        self.set_map_court(map_court)
+
+    def set_image(self, image):
+        '''
+        Used for loading image of the current frame
+        '''
+
         self.image      = image
-        self.map_court  = map_court
+
+    def set_map_court(self, map_court):
+        '''
+        Used for loading clean court map once per run, copies are drawn on each frame
+        '''
+
+        self.map_court_base = map_court
+        self.map_court_base.setflags(write=False)
+
+        self.map_court_scaled = {}
+
+    def get_map_court(self, scale):
+        '''
+        Returns writable copy of clean court map resized by scale, resizing is done once for each scale
+        '''
+
+        if scale not in self.map_court_scaled:
+
+            if scale == 1:
+                map_court = self.map_court_base
+            else:
+                width = int(self.map_court_base.shape[1] * scale)
+                height = int(self.map_court_base.shape[0] * scale)
+                map_court = cv2.resize(self.map_court_base, (width, height), interpolation = cv2.INTER_AREA)
+                map_court.setflags(write=False)
+
+            self.map_court_scaled[scale] = map_court
+
+        return self.map_court_scaled[scale].copy()
+
+    def get_map_point(self, position_court):
+        '''
+        Returns pixel of court position on map currently drawn on
+        '''
+
+        x, y = (position_court[0][0] * self.map_scale).astype(int)
+
+        return (x, y)
+
+    def get_map_size(self, size):
+        '''
+        Returns size in pixels on map currently drawn on, given for map of original size
+        '''
+        return max(1, int(round(size * self.map_scale)))
+
+    def get_text_size(self, text, text_scale, text_thickness):
+        '''
+        Returns size of text, computed once for each text and scale
+        '''
+
+        key = (text, text_scale, text_thickness)
+
+        if key not in self.text_sizes:
+            self.text_sizes[key], _ = cv2.getTextSize(text, CONFIG.TEXT_FACE, text_scale, text_thickness)
+
+        return self.text_sizes[key]
 
     def draw_court_masks_on_image(self, court_masks, image_draw_court_mask, image_keypoints):
 
@@ -34,8 +119,7 @@ class VisualizationHandler(object):
             #     self.image = cv2.addWeighted(self.image.astype(float), 1, rgb_mask.astype(float), 0.5, 0)
 
             if not 'basket' in m and image_draw_court_mask:
-                rgb_mask = self.get_color_mask(m_value, CONFIG.COURT_FEATURES_COLORS[m])
-                self.image = cv2.addWeighted(self.image.astype(np.float), 1, rgb_mask.astype(np.float), 1, 0)
+                self.add_color_mask(m_value, CONFIG.COURT_FEATURES_COLORS[m])
 
         for k in image_keypoints[0]:
             x,y = k.astype(int)
@@ -45,35 +129,34 @@ class VisualizationHandler(object):
 
         for p,p_value in person.items():
 
-            # Draw lines
-            for l, l_value in CONFIG.PERSON_POSE_CONNECTIONS.items():
+            # Positions and their validity are read from person registry, body parts are indices
+            registry, i = p_value.registry, p_value.index
 
-                for ll in l_value:
+            positions = registry.positions_image[i].astype(int)
+            valid = registry.positions_image_valid[i]
 
-                    l_pos = 'pos_' + l
-                    ll_pos = 'pos_' + ll
+            # Draw lines
+            for j_l, j_ll in registry.connections:
 
-                    if l_pos in p_value.positions_image and ll_pos in p_value.positions_image:
+                if valid[j_l] and valid[j_ll]:
 
-                        x_l, y_l = p_value.positions_image[l_pos][0][0].astype(np.int)
-                        x_ll, y_ll = p_value.positions_image[ll_pos][0][0].astype(np.int)
-                        
-                        # Choose color
-                        if color_person == 'team':
-                            cv2.line(self.image, (x_l, y_l), (x_ll, y_ll), p_value.color_team, 2)
-                        elif color_person == 'random':
-                            temp_color = CONFIG.PERSON_PLAYER_COLOR[random.randrange(0,len(CONFIG.PERSON_PLAYER_COLOR))]
-                            cv2.line(self.image, (x_l, y_l), (x_ll, y_ll), temp_color, 2)
-                        else:
-                            cv2.line(self.image, (x_l, y_l), (x_ll, y_ll), p_value.color_unique, 2)
+                    x_l, y_l = positions[j_l]
+                    x_ll, y_ll = positions[j_ll]
 
-            # Draw dots
-            for c, c_value in CONFIG.PERSON_POSE_COLORS.items():
+                    # Choose color
+                    if color_person == 'team':
+                        cv2.line(self.image, (x_l, y_l), (x_ll, y_ll), p_value.color_team, 2)
+                    elif color_person == 'random':
+                        temp_color = CONFIG.PERSON_PLAYER_COLOR[random.randrange(0,len(CONFIG.PERSON_PLAYER_COLOR))]
+                        cv2.line(self.image, (x_l, y_l), (x_ll, y_ll), temp_color, 2)
+                    else:
+                        cv2.line(self.image, (x_l, y_l), (x_ll, y_ll), p_value.color_unique, 2)
 
-                c_pos = 'pos_' + c
+            # Draw dots
+            for j, c_value in registry.part_colors:
 
-                if c_pos in p_value.positions_image:
-                    x, y = p_value.positions_image[c_pos][0][0].astype(np.int)
+                if valid[j]:
+                    x, y = positions[j]
                     cv2.circle(self.image, tuple([x,y]), CONFIG.IMAGE_POINT_SIZE, c_value, -1)
 
     def draw_person_on_map(self, person, color_person):
@@ -84,9 +167,7 @@ class VisualizationHandler(object):
             if p_value.position_court is None:
                 continue
 
-            x, y = p_value.position_court[0][0].astype(np.int)
-
-            center = tuple([x,y])
+            center = self.get_map_point(p_value.position_court)
 
             # Only players draw text, https://stackoverflow.com/questions/55904418/draw-text-inside-circle-opencv
             if not 'REFEREE' in p:
@@ -98,21 +179,22 @@ class VisualizationHandler(object):
                 else:
                     continue
 
-                cv2.circle(self.map_court, center, CONFIG.TEXT_POINT_SIZE, color_jersey, -1)
+                cv2.circle(self.map_court, center, self.get_map_size(CONFIG.TEXT_POINT_SIZE), color_jersey, -1)
 
                 text = str(p_value.number)
-                text_size, _ = cv2.getTextSize(text, CONFIG.TEXT_FACE, CONFIG.TEXT_SCALE, CONFIG.TEXT_THICKNESS)
+                text_scale = CONFIG.TEXT_SCALE * self.map_scale
+                text_thickness = self.get_map_size(CONFIG.TEXT_THICKNESS)
+                text_size = self.get_text_size(text, text_scale, text_thickness)
                 text_origin = (int(center[0] - text_size[0] / 2), int(center[1] + text_size[1] / 2))
 
-                cv2.putText(self.map_court, text, text_origin, CONFIG.TEXT_FACE, CONFIG.TEXT_SCALE, p_value.color_number, CONFIG.TEXT_THICKNESS, cv2.LINE_AA)
+                cv2.putText(self.map_court, text, text_origin, CONFIG.TEXT_FACE, text_scale, p_value.color_number, text_thickness, cv2.LINE_AA)
 
             else:
-                cv2.circle(self.map_court, center, CONFIG.MAP_POINT_SIZE, CONFIG.PERSON_REFEREE_COLOR, -1)
+                cv2.circle(self.map_court, center, self.get_map_size(CONFIG.MAP_POINT_SIZE), CONFIG.PERSON_REFEREE_COLOR, -1)
 
     def draw_basket_on_image(self, court_masks):
         
-        rgb_mask = self.get_color_mask(court_masks['basket_ball'], CONFIG.COURT_FEATURES_COLORS['basket_ball'])
-        self.image = cv2.addWeighted(self.image.astype(np.float), 1, rgb_mask.astype(np.float), 1, 0)  
+        self.add_color_mask(court_masks['basket_ball'], CONFIG.COURT_FEATURES_COLORS['basket_ball'])
 
     def draw_basket_on_map(self, person, possesion):
 
@@ -122,15 +204,33 @@ class VisualizationHandler(object):
         if person[possesion].position_court is None:
             return
 
-        x, y = person[possesion].position_court[0][0].astype(np.int)
-        cv2.circle(self.map_court, (x,y), CONFIG.TEXT_POINT_SIZE + 1, CONFIG.COURT_FEATURES_COLORS['basket_ball'], 5)
+        center = self.get_map_point(person[possesion].position_court)
+        cv2.circle(self.map_court, center, self.get_map_size(CONFIG.TEXT_POINT_SIZE + 1), CONFIG.COURT_FEATURES_COLORS['basket_ball'], self.get_map_size(5))
+
+    def draw_and_save(self, frame, *args, **kwargs):
+        '''
+        Draw current frame and write it to the sink. Arguments are the same as for draw.
+        '''
+
+        with profiling.profiler.stage('render'):
+            out_image = self.draw(*args, **kwargs)
+
+        self.write(frame, out_image)
 
-    def draw_and_save(self, frame, person, court_masks, ball_possesion, image_keypoints,
+    def write(self, frame, image):
+        '''
+        Write drawn frame to the sink.
+        '''
+
+        with profiling.profiler.stage('write'):
+            self.sink.write(frame, image)
+
+    def draw(self, person, court_masks, ball_possesion, image_keypoints,
         layout='image_map',
         image_draw_black_background=False, image_draw_court_mask=False, image_draw_basket=True, image_draw_person=True,
         color_person='team'):
         '''
-        Save current frame as png.
+        Returns drawn current frame.
 
         layout                      : str, ['image_map', 'image', 'map']
 
@@ -145,7 +245,12 @@ class VisualizationHandler(object):
         # -------
         # Draw without rgb image
         if image_draw_black_background:
-            self.image = np.zeros(self.image.shape)#.astype(int)
+            self.image = np.zeros_like(self.image)
+
+        # ------------------------------
+        # Map is drawn directly in the size it has in the layout
+        self.map_scale = self.map_scale_percent / 100 if layout == 'image_map' else 1.
+        self.map_court = self.get_map_court(self.map_scale)
 
         # ------------------------------
         # Layouts
@@ -185,11 +290,7 @@ class VisualizationHandler(object):
                 self.draw_person_on_image(person, color_person)
                 self.draw_person_on_map(person, color_person)
 
-            # Prepare map court layout
-            scale_percent = 40 # percent of original size
-            width = int(self.map_court.shape[1] * scale_percent / 100)
-            height = int(self.map_court.shape[0] * scale_percent / 100)
-            map_court = cv2.resize(self.map_court, (width, height), interpolation = cv2.INTER_AREA)
+            map_court = self.map_court
 
             # Final layout is defined by image and map size
             h1, w1, c1 = self.image.shape
@@ -197,21 +298,269 @@ class VisualizationHandler(object):
             h, w = h1+h2, max(w1, w2)
             w_shift = int((w-min(w1, w2))/2)
 
-            out_image = np.zeros((h,w,c1))
+            # Canvas is allocated once, the same regions are overwritten every frame
+            if self.canvas is None or self.canvas.shape != (h,w,c1):
+                self.canvas = np.zeros((h,w,c1), dtype=np.uint8)
+
+            out_image = self.canvas
             out_image[:h1,:w1, ] = self.image
             out_image[h1:h1+h2,w_shift:w2+w_shift, ] = map_court
 
+        return out_image
 
-        cv2.imwrite("../tmp/{}.png".format(frame), out_image)  
+    def add_color_mask(self, mask, color):
+        '''
+        Adds color to image pixels under the mask, in place and saturated to uint8.
+        Only the bounding box of the mask is touched. Mask is full size array or utils.SparseMask.
+        '''
 
-    def get_color_mask(self, mask, color):
+        if isinstance(mask, utils.SparseMask):
 
-        r = np.zeros_like(mask).astype(np.float)
-        g = np.zeros_like(mask).astype(np.uint8)
-        b = np.zeros_like(mask).astype(np.uint8)
+            x, y = mask.x, mask.y
+            h, w = mask.crop.shape
+            selection = mask.crop > 0
 
-        b[mask > 0], g[mask > 0], r[mask > 0] = color
-        
-        coloured_mask = np.stack([b, g, r], axis=2)
-        
-        return coloured_mask
+        else:
+
+            if mask.dtype != np.uint8:
+                mask = mask.astype(np.uint8)
+
+            x, y, w, h = cv2.boundingRect(mask)
+            selection = mask[y:y+h, x:x+w] > 0
+
+        if w == 0 or h == 0:
+            return
+
+        # Masks downsampled at load time are brought back to image size, sample (i, j) is pixel (i*n, j*n)
+        scale = int(round(self.image.shape[0] / mask.shape[0]))
+
+        if scale != 1:
+            selection = np.repeat(np.repeat(selection, scale, axis=0), scale, axis=1)
+            x, y = x*scale, y*scale
+            selection = selection[:self.image.shape[0]-y, :self.image.shape[1]-x]
+            h, w = selection.shape
+
+        roi = self.image[y:y+h, x:x+w]
+
+        pixels = roi[selection].astype(np.int16) + np.array(color, dtype=np.int16)
+        roi[selection] = np.minimum(pixels, 255).astype(np.uint8)
+
+# ----------------------------------
+# Output sinks. Each sink has write(frame, image) and close(). Sinks with ordered = True
+# must get frames in frame order from a single process.
+
+def get_sink(output_format, path_output=None, fps=20):
+    '''
+    Returns output sink.
+
+    output_format : str, ['png', 'video', 'ffmpeg'], png sequence, cv2.VideoWriter or ffmpeg subprocess
+    path_output   : str, directory for png sequence, video file otherwise
+    fps           : int, frame rate of video
+    '''
+
+    if output_format == 'png':
+        return PngSequenceSink(path_output or '../tmp')
+    elif output_format == 'video':
+        return VideoWriterSink(path_output or '../tmp/movie.mp4', fps)
+    elif output_format == 'ffmpeg':
+        return FfmpegPipeSink(path_output or '../tmp/movie.mp4', fps)
+
+    raise ValueError('Unknown output format {}'.format(output_format))
+
+def get_uint8_image(image):
+    '''
+    Returns image as uint8, values are saturated as cv2.imwrite does.
+    '''
+
+    if image.dtype == np.uint8:
+        return image
+
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+class PngSequenceSink(object):
+    """
+    Writes every frame as <path_output>/<frame>.png
+    """
+    ordered = False
+
+    def __init__(self, path_output):
+        super(PngSequenceSink, self).__init__()
+
+        self.path_output = path_output
+
+        os.makedirs(self.path_output, exist_ok=True)
+
+    def write(self, frame, image):
+        cv2.imwrite(os.path.join(self.path_output, '{}.png'.format(frame)), image)
+
+    def close(self):
+        pass
+
+class VideoWriterSink(object):
+    """
+    Encodes frames into video file with cv2.VideoWriter. Frame size is taken from the first frame.
+    """
+    ordered = True
+
+    def __init__(self, path_output, fps=20, fourcc='mp4v'):
+        super(VideoWriterSink, self).__init__()
+
+        self.path_output    = path_output
+        self.fps            = fps
+        self.fourcc         = fourcc
+
+        self.writer         = None
+
+    def write(self, frame, image):
+
+        if self.writer is None:
+
+            os.makedirs(os.path.dirname(os.path.abspath(self.path_output)), exist_ok=True)
+
+            h, w = image.shape[:2]
+            self.writer = cv2.VideoWriter(self.path_output, cv2.VideoWriter_fourcc(*self.fourcc), self.fps, (w, h))
+
+            if not self.writer.isOpened():
+                raise IOError('Can not open video writer for {}'.format(self.path_output))
+
+        self.writer.write(get_uint8_image(image))
+
+    def close(self):
+
+        if self.writer is not None:
+            self.writer.release()
+            self.writer = None
+
+class FfmpegPipeSink(object):
+    """
+    Streams raw BGR frames to ffmpeg subprocess which encodes them. Frame size is taken from the first frame.
+    """
+    ordered = True
+
+    def __init__(self, path_output, fps=20, codec='libx264', ffmpeg='ffmpeg'):
+        super(FfmpegPipeSink, self).__init__()
+
+        self.path_output    = path_output
+        self.fps            = fps
+        self.codec          = codec
+        self.ffmpeg         = ffmpeg
+
+        self.process        = None
+
+    def write(self, frame, image):
+
+        if self.process is None:
+
+            os.makedirs(os.path.dirname(os.path.abspath(self.path_output)), exist_ok=True)
+
+            h, w = image.shape[:2]
+            command = [self.ffmpeg, '-y', '-loglevel', 'error',
+                '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', '{}x{}'.format(w, h), '-r', str(self.fps), '-i', '-',
+                # yuv420p needs even frame size
+                '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-c:v', self.codec, '-pix_fmt', 'yuv420p', self.path_output]
+
+            self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+        self.process.stdin.write(get_uint8_image(image).tobytes())
+
+    def close(self):
+
+        if self.process is not None:
+            self.process.stdin.close()
+            self.process.wait()
+            self.process = None
+
+# ----------------------------------
+# Render-only mode, frames are drawn from tracking store written by main.py --tracking_path
+
+def get_layout_sinks(layouts, output_format, path_output=None, fps=20):
+    '''
+    Returns dictionary with layout as a key and its sink as a value. With more than one layout
+    png sequences go to <path_output>/<layout>, videos to <name>_<layout>.<ext>.
+    '''
+
+    if len(layouts) == 1:
+        return {layouts[0]: get_sink(output_format, path_output, fps)}
+
+    sinks = {}
+
+    for l in layouts:
+
+        if output_format == 'png':
+            path = os.path.join(path_output or '../tmp', l)
+        else:
+            root, ext = os.path.splitext(path_output or '../tmp/movie.mp4')
+            path = '{}_{}{}'.format(root, l, ext)
+
+        sinks[l] = get_sink(output_format, path, fps)
+
+    return sinks
+
+def render_tracking(data_loader, store, sinks, map_scale_percent=40, **kwargs):
+    '''
+    Draws every frame of tracking.TrackingStore in all layouts in one pass, no masks are fitted.
+    Frame image and court masks needed for drawing are loaded once per frame and shared by all layouts.
+
+    sinks   : Dictionary with layout as a key and sink as a value, see get_layout_sinks
+    kwargs  : draw options (color_person, image_draw_court_mask, ...) used for all layouts
+    '''
+
+    map_court = data_loader.get_map_court()
+
+    visual_handlers = {}
+
+    for l, sink in sinks.items():
+        visual_handlers[l] = VisualizationHandler(sink, map_scale_percent)
+        visual_handlers[l].set_map_court(map_court)
+
+    # Map layout does not need anything from the image
+    image_needed = any(l != 'map' for l in sinks) or kwargs.get('image_draw_black_background')
+
+    features = None if kwargs.get('image_draw_court_mask') else ['basket_ball']
+
+    for i, f in enumerate(store.frames):
+
+        print('Rendering frame {}'.format(f))
+
+        image       = data_loader.get_frame_image(f) if image_needed else None
+        masks_court = data_loader.get_masks_court(f, features) if image_needed else {}
+
+        snapshot = store.get_snapshot(i, masks_court)
+
+        for l, visual_handler in visual_handlers.items():
+
+            # Drawing is in place, every layout gets its own copy of the image
+            visual_handler.set_image(image.copy() if image is not None else None)
+
+            visual_handler.draw_and_save(f, snapshot.person, snapshot.masks_court, snapshot.ball_possesion, snapshot.image_keypoints, layout=l, **kwargs)
+
+    for visual_handler in visual_handlers.values():
+        visual_handler.sink.close()
+
+if __name__ == '__main__':
+
+    # python visual.py --path_data '/Users/benjamin/Documents/data/basketball/2016_finals' --path_tracking ../tmp/tracking --layouts image_map map
+
+    import argparse
+
+    import game
+    import tracking
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--path_data", type=str, help="Path to images, masks, list of frames.", required=True)
+    parser.add_argument("--path_tracking", type=str, help="Tracking store written by main.py --tracking_path.", required=True)
+    parser.add_argument("--backend", type=str, default='png', choices=['png', 'archive'], help="Read masks from png tree or from archive packed with archive.py.", required=False)
+    parser.add_argument("--layouts", type=str, nargs='+', default=['image_map'], choices=['image_map', 'image', 'map'], help="Layouts drawn in one pass, each to its own output.", required=False)
+    parser.add_argument("--color_person", type=str, default='team', choices=['team', 'random', 'unique'], help="Color of persons: team jersey, random or unique per player.", required=False)
+    parser.add_argument("--image_draw_court_mask", action='store_true', help="Draw court lines and keypoints on image.", required=False)
+    parser.add_argument("--image_draw_black_background", action='store_true', help="Draw on black background instead of frame image.", required=False)
+    parser.add_argument("--map_scale_percent", type=int, default=40, help="Size of court map in image_map layout, percent of original size.", required=False)
+    parser.add_argument("--output_format", type=str, default='png', choices=['png', 'video', 'ffmpeg'], help="Write png sequence, video with cv2.VideoWriter or stream to ffmpeg.", required=False)
+    parser.add_argument("--output_path", type=str, default=None, help="Output directory for png, output file for video (default ../tmp, ../tmp/movie.mp4).", required=False)
+    parser.add_argument("--fps", type=int, default=20, help="Frame rate of output video.", required=False)
+    args = parser.parse_args()
+
+    render_tracking(game.DataLoader(args.path_data, args.backend), tracking.TrackingStore(args.path_tracking),
+        get_layout_sinks(args.layouts, args.output_format, args.output_path, args.fps), args.map_scale_percent,
+        color_person=args.color_person, image_draw_court_mask=args.image_draw_court_mask,
+        image_draw_black_background=args.image_draw_black_background)